@@ -29,6 +29,9 @@
 
 __author__="ayanichkin"
 
+import bisect
+import json
+import multiprocessing
 import re
 
 def escape(ch):
@@ -73,6 +76,43 @@ class Null(object):
 class ParserError(Exception):
   pass
 
+# Индекс начал строк текста. Строится за один проход регулярным выражением,
+# после чего строка и столбец для любого смещения вычисляются двоичным поиском,
+# без повторного просмотра текста. Для единственного смещения индекс не нужен
+# (см. locate).
+class LineIndex(object):
+  # Пара \r\n считается одним переводом строки.
+  re_newline = re.compile(r'\r\n?|\n')
+
+  def __init__(self, input):
+    # Смещения начал строк текста.
+    self.starts = [0]
+    self.starts.extend(m.end() for m in self.re_newline.finditer(input))
+    self._input = input
+
+  def position(self, offset):
+    u"""Возвращает кортеж (строка, столбец), отсчитываемые с 1, для смещения offset."""
+    i = bisect.bisect_right(self.starts, offset) - 1
+    # Смещение между \r и \n уже считается началом новой строки.
+    if offset > 0 and self._input[offset-1:offset+1] == '\r\n':
+      return (i + 2, 1)
+    return (i + 1, offset - self.starts[i] + 1)
+
+  @classmethod
+  def locate(cls, input, offset):
+    u"""
+    Возвращает то же, что и LineIndex(input).position(offset), просматривая текст
+    только до offset и не запоминая начала строк.
+    """
+    line = 1
+    start = 0
+    # Перевод строки \r\n, разрезанный offset-ом, находится как \r, и offset
+    # оказывается в начале следующей строки, как и в position.
+    for m in cls.re_newline.finditer(input, 0, offset):
+      line += 1
+      start = m.end()
+    return (line, offset - start + 1)
+
 # Кидается, когда парсер встречает синтаксическую ошибку.
 class SyntaxError(ParserError):
   def __init__(self, expected, found, offset, line, column):
@@ -82,6 +122,9 @@ class SyntaxError(ParserError):
     self.offset = offset;
     self.line = line;
     self.column = column;
+  # Исключение должно передаваться из процессов пула (см. parse_many).
+  def __reduce__(self):
+    return (type(self), (self.expected, self.found, self.offset, self.line, self.column))
   
   @staticmethod
   def buildMessage(expected, found):
@@ -106,16 +149,23 @@ class ValueElementContentParser(object):
   rec_number= re.compile('^[0-9]')
   rec_hex   = re.compile('^[0-9a-fA-F]')
 
-  def __init__(self):
+  def __init__(self, fast = True):
+    # Если True, вход сначала разбирается без учета ожидаемых в месте ошибки
+    # лексем, и только если разбор не удался, разбирается повторно с их учетом,
+    # чтобы построить SyntaxError. Почти все разбираемые значения корректны,
+    # поэтому учет ожидаемых лексем при успешном разборе -- лишняя работа.
+    self.fast = fast
+    # Правила вызываются для контекста разбора, а не для самого разборщика,
+    # поэтому храним несвязанные методы.
     self.parseFunctions = {
-      "_"     : self.__parse_whitespace,
-      "value" : self.__parse_value,
-      "list"  : self.__parse_list,
-      "string": self.__parse_string,
-      "char"  : self.__parse_char,
-      "hex"   : self.__parse_hex,
-      "hex4"  : self.__parse_hex4,
-      "number": self.__parse_number
+      "_"     : ValueElementContentParser.__parse_whitespace,
+      "value" : ValueElementContentParser.__parse_value,
+      "list"  : ValueElementContentParser.__parse_list,
+      "string": ValueElementContentParser.__parse_string,
+      "char"  : ValueElementContentParser.__parse_char,
+      "hex"   : ValueElementContentParser.__parse_hex,
+      "hex4"  : ValueElementContentParser.__parse_hex4,
+      "number": ValueElementContentParser.__parse_number
     };
 
   #
@@ -126,18 +176,52 @@ class ValueElementContentParser(object):
   #
   def parse(self, input, startRule = None):
 
-    self.pos = 0;
-    self.reportFailures = 0;
-    self.rightmostFailuresPos = 0;
-    self.rightmostFailuresExpected = [];
-
     if startRule is not None:
       if self.parseFunctions[startRule] is None:
         raise ParserError(u'Invalid rule name: %s.' % quote(startRule));
     else:
       startRule = 'value';
 
-    result = self.parseFunctions[startRule](input);
+    return self._context()._parse(input, startRule)
+
+  # Разборщик передается в процессы пула (см. ParserPool). Несвязанные методы из
+  # parseFunctions не сериализуются, поэтому передается только конфигурация.
+  def __reduce__(self):
+    return (type(self), (self.fast,))
+
+  # Возвращает контекст для одного вызова разбора -- копию разборщика, в которой
+  # хранится состояние разбора (позиция, ожидаемые в месте ошибки лексемы).
+  # Сам разборщик при разборе не изменяется, поэтому один экземпляр можно
+  # использовать одновременно из нескольких потоков и рекурсивно.
+  def _context(self):
+    context = object.__new__(type(self))
+    context.__dict__.update(self.__dict__)
+    return context
+
+  # Методы ниже изменяют состояние и вызываются только для контекста разбора.
+
+  # Разбирает вход. Состояние разбора сбрасывается в начале (см. _run), поэтому один
+  # контекст можно использовать для многих входов подряд.
+  def _parse(self, input, startRule):
+    if self.fast:
+      # Ненулевой reportFailures отключает вызовы __matchFailed во всех правилах.
+      result = self._run(input, startRule, 1)
+      if result is not Null and self.pos == len(input):
+        return result
+    return self._parseWithDiagnostics(input, startRule)
+
+  def _run(self, input, startRule, reportFailures):
+    self.pos = 0;
+    self.reportFailures = reportFailures;
+    self.rightmostFailuresPos = 0;
+    self.rightmostFailuresExpected = [];
+
+    return self.parseFunctions[startRule](self, input);
+
+  # Разбирает вход, запоминая ожидаемые лексемы в месте ошибки, и при неудаче
+  # кидает SyntaxError с ними.
+  def _parseWithDiagnostics(self, input, startRule):
+    result = self._run(input, startRule, 0)
 
     #
     # Сейчас парсер в одном из следующих трех состояний:
@@ -165,11 +249,11 @@ class ValueElementContentParser(object):
     #
     if result is Null or self.pos != len(input):
       offset = max(self.pos, self.rightmostFailuresPos);
-      found = offset < len(input) and input[offset] or Null;
-      errorPosition = self.__computeErrorPosition(offset, input);
+      found = offset < len(input) and input[offset] or None;
+      errorPosition = self._computeErrorPosition(offset, input);
 
       raise SyntaxError(
-        self.__cleanupExpected(self.rightmostFailuresExpected),
+        self._cleanupExpected(self.rightmostFailuresExpected),
         found,
         offset,
         errorPosition[0],
@@ -178,6 +262,21 @@ class ValueElementContentParser(object):
 
     return result;
 
+  def parse_many(self, inputs, processes = None):
+    u"""
+    Разбирает все строки из inputs и возвращает список результатов в том же порядке.
+    При ошибке кидает исключение для первой по порядку строки, которую не удалось разобрать.
+
+    processes - если больше 1, строки разбиваются на части, которые разбираются
+                параллельно в пуле из указанного количества процессов. Вместо
+                количества можно передать уже созданный пул (ParserPool).
+    """
+    if _usesPool(processes):
+      return parseInPool(self, inputs, processes)
+    # Все строки разбираются в одном контексте.
+    parse = self._context()._parse
+    return [parse(input, 'value') for input in inputs]
+
   # Парсеры правил
 
   def __parse_whitespace(self, input):
@@ -207,92 +306,109 @@ class ValueElementContentParser(object):
       self.__matchFailed('Whitespace');
     return result0;
 
+  # Правило value разбирается без рекурсии: списки, разбор которых еще не закончен
+  # (правило list, вызванное из value), хранятся в явном стеке, поэтому глубина
+  # вложенности ограничена только памятью. Проверки, откаты позиции и вызовы
+  # __matchFailed те же и в том же порядке, что и при рекурсивном разборе
+  # '{' _ list _ '}', поэтому результаты и ошибки от него не отличаются.
   def __parse_value(self, input):
-    result0 = result1 = result2 = result3 = result4 = Null;
-    pos0 = pos1 = self.pos;
-
-    if ord(self.char(input, self.pos)) == 123:# {
-      result0 = '{';
-      self.pos += 1;
-    else:
-      result0 = Null;
+    # Незаконченные списки: [позиция '{', разобранные элементы (Null, пока
+    # разбирается первый элемент), позиция отката, если следующий элемент
+    # разобрать не удастся].
+    stack = [];
+    while True:
+      pos0 = self.pos;
+      if self.char(input, self.pos) == '{':
+        self.pos += 1;
+        self.__parse_whitespace(input);
+        stack.append([pos0, Null, self.pos]);
+        continue;
       if self.reportFailures == 0:
         self.__matchFailed("'{'");
-    if result0 is not Null:
-      result1 = self.__parse_whitespace(input);
-      if result1 is not Null:
-        result2 = self.__parse_list(input);
-        if result2 is not Null:
-          result3 = self.__parse_whitespace(input);
-          if result3 is not Null:
-            if ord(self.char(input, self.pos)) == 125:# }
-              result4 = '}';
-              self.pos += 1;
-            else:
-              result4 = Null;
-              if self.reportFailures == 0:
-                self.__matchFailed("'}'");
-            if result4 is not Null:
-              result0 = [result0, result1, result2, result3, result4];
-            else:
-              result0 = Null;
-              self.pos = pos1;
+      result0 = self.__parse_scalar(input);
+
+      # Передаем разобранное (или не разобранное) значение объемлющим спискам.
+      while stack:
+        frame = stack[-1];
+        items = frame[1];
+        if result0 is not Null:
+          if items is Null:
+            # Пробельные символы перед запятой допустимы только после первого элемента.
+            self.__parse_whitespace(input);
+            items = frame[1] = [result0];
           else:
-            result0 = Null;
-            self.pos = pos1;
+            items.append(result0);
+          pos1 = self.pos;
+          if self.char(input, self.pos) == ',':
+            self.pos += 1;
+            self.__parse_whitespace(input);
+            frame[2] = pos1;
+            break;
+          if self.reportFailures == 0:
+            self.__matchFailed("','");
         else:
-          result0 = Null;
-          self.pos = pos1;
+          # Не разобран первый элемент -- список пуст, следующий -- список
+          # заканчивается перед его запятой.
+          self.pos = frame[2];
+          if items is Null:
+            items = [];
+        # Список закончен, ожидается закрывающая скобка.
+        stack.pop();
+        self.__parse_whitespace(input);
+        if self.char(input, self.pos) == '}':
+          self.pos += 1;
+          result0 = items;
+        else:
+          if self.reportFailures == 0:
+            self.__matchFailed("'}'");
+          self.pos = frame[0];
+          result0 = self.__parse_scalar(input);
       else:
-        result0 = Null;
-        self.pos = pos1;
+        return result0;
+
+  # Остальные альтернативы правила value: 'null', 'true', 'false', number, string.
+  def __parse_scalar(self, input):
+    pos0 = self.pos;
+    if input[self.pos:self.pos+4] == 'null':
+      result0 = 'null';
+      self.pos += 4;
     else:
       result0 = Null;
-      self.pos = pos1;
+      if self.reportFailures == 0:
+        self.__matchFailed("'null'");
+
     if result0 is not Null:
-      result0 = result0[2];# Действие
+      result0 = None;# Действие
     else:
       self.pos = pos0;
-      if input[self.pos:self.pos+4] == 'null':
-        result0 = 'null';
+    if result0 is Null:
+      pos0 = self.pos;
+      if input[self.pos:self.pos+4] == 'true':
+        result0 = 'true';
         self.pos += 4;
       else:
         result0 = Null;
         if self.reportFailures == 0:
-          self.__matchFailed("'null'");
-
+          self.__matchFailed("'true'");
       if result0 is not Null:
-        result0 = None;# Действие
+        result0 = True;# Действие
       else:
         self.pos = pos0;
-      if result0 is Null:
-        pos0 = self.pos;
-        if input[self.pos:self.pos+4] == 'true':
-          result0 = 'true';
-          self.pos += 4;
+        if input[self.pos: self.pos+5] == 'false':
+          result0 = 'false';
+          self.pos += 5;
         else:
           result0 = Null;
           if self.reportFailures == 0:
-            self.__matchFailed("'true'");
+            self.__matchFailed("'false'");
         if result0 is not Null:
-          result0 = True;# Действие
+          result0 = False;# Действие
         else:
           self.pos = pos0;
-          if input[self.pos: self.pos+5] == 'false':
-            result0 = 'false';
-            self.pos += 5;
-          else:
-            result0 = Null;
-            if self.reportFailures == 0:
-              self.__matchFailed("'false'");
-          if result0 is not Null:
-            result0 = False;# Действие
-          else:
-            self.pos = pos0;
+        if result0 is Null:
+          result0 = self.__parse_number(input);
           if result0 is Null:
-            result0 = self.__parse_number(input);
-            if result0 is Null:
-              result0 = self.__parse_string(input);
+            result0 = self.__parse_string(input);
     return result0;
 
   def __parse_list(self, input):
@@ -308,7 +424,7 @@ class ValueElementContentParser(object):
         result2 = [];
         pos2 = self.pos;
         pos3 = self.pos;
-        if ord(self.char(input, self.pos)) == 44:# ,
+        if self.char(input, self.pos) == ',':
           result3 = ',';
           self.pos += 1;
         else:
@@ -338,7 +454,7 @@ class ValueElementContentParser(object):
           result2.append(result3);
           pos2 = self.pos;
           pos3 = self.pos;
-          if ord(self.char(input, self.pos)) == 44:# ,
+          if self.char(input, self.pos) == ',':
             result3 = ',';
             self.pos += 1;
           else:
@@ -389,7 +505,7 @@ class ValueElementContentParser(object):
     result0 = result1 = result2 = Null;
     pos0 = pos1 = self.pos;
 
-    if ord(self.char(input, self.pos)) == 34:# "
+    if self.char(input, self.pos) == '"':
       result0 = '"';
       self.pos += 1;
     else:
@@ -403,7 +519,7 @@ class ValueElementContentParser(object):
         result1.append(result2);
         result2 = self.__parse_char(input);
       if result1 is not Null:
-        if ord(self.char(input, self.pos)) == 34:
+        if self.char(input, self.pos) == '"':
           result2 = '"';
           self.pos += 1;
         else:
@@ -433,7 +549,7 @@ class ValueElementContentParser(object):
     
     pos0 = self.pos;
     pos1 = self.pos;
-    if ord(self.char(input, self.pos)) == 92:# \
+    if self.char(input, self.pos) == '\\':
       result0 = '\\';
       self.pos += 1;
     else:
@@ -457,7 +573,7 @@ class ValueElementContentParser(object):
     if result0 is Null:
       pos0 = self.pos;
       pos1 = self.pos;
-      if ord(self.char(input, self.pos)) == 92:
+      if self.char(input, self.pos) == '\\':
         result0 = '\\';
         self.pos += 1;
       else:
@@ -541,7 +657,7 @@ class ValueElementContentParser(object):
     result0 = result1 = result2 = Null;
     pos0 = pos1 = self.pos;
 
-    if ord(self.char(input, self.pos)) == 45:# -
+    if self.char(input, self.pos) == '-':
       result0 = "-";
       self.pos += 1;
     else:
@@ -605,36 +721,13 @@ class ValueElementContentParser(object):
 
     self.rightmostFailuresExpected.append(failureMessage);
 
+  # Позиция ошибки нужна для одного смещения, поэтому индекс строк не строится.
   @staticmethod
-  def __computeErrorPosition(offset, input):
-    #
-    # The first idea was to use |String.split| to break the input up to the
-    # error position along newlines and derive the line and column from
-    # there. However IE's |split| implementation is so broken that it was
-    # enough to prevent it.
-    #
-
-    line = 1;
-    column = 1;
-    seenCR = False;
-    for ch in input[:offset]:
-      if ch == '\n':
-        if not seenCR:
-          line += 1;
-        column = 1;
-        seenCR = False;
-      elif ch == '\r' or ch == '\u2028' or ch == '\u2029':
-        line += 1;
-        column = 1;
-        seenCR = True;
-      else:
-        column += 1;
-        seenCR = False;
-
-    return (line, column);
+  def _computeErrorPosition(offset, input):
+    return LineIndex.locate(input, offset);
 
   @staticmethod
-  def __cleanupExpected(expected):
+  def _cleanupExpected(expected):
     expected.sort();
 
     lastExpected = Null;
@@ -644,3 +737,531 @@ class ValueElementContentParser(object):
         cleanExpected.append(e);
         lastExpected = e;
     return cleanExpected;
+
+
+# Быстрый разборщик содержимого элементов VALUE.
+#
+# В отличие от ValueElementContentParser, который проверяет регулярным выражением
+# каждый символ входа, за одно сопоставление забирает целую лексему: строку без
+# экранированных символов, число, литерал null/true/false или пробельные символы.
+# Результат разбора полностью совпадает с результатом ValueElementContentParser.
+# Если вход не удалось разобрать, он разбирается повторно ValueElementContentParser-ом,
+# чтобы получить в точности такое же исключение SyntaxError.
+class ValueElementContentScanner(ValueElementContentParser):
+  # Начало значения: открывающая скобка списка, строка без экранирования, число,
+  # литерал, строка с экранированием. Минус перед строкой допускается исходной
+  # грамматикой (неудачная попытка разобрать число не откатывает позицию), поэтому
+  # он допускается и здесь.
+  re_value  = re.compile(r'(\{)|"([^"\\]*)"|(-?[0-9]+)|(null|true|false)|-?"((?:[^"\\]|\\.)*)"', re.S)
+  re_ws     = re.compile(r'[ \t\r\n]*')
+  re_escape = re.compile(r'\\([0-9a-fA-F]{4}|.)', re.S)
+
+  literals = {'null': None, 'true': True, 'false': False}
+
+  def parse(self, input, startRule = None):
+    if startRule is not None and startRule != 'value':
+      return super(ValueElementContentScanner, self).parse(input, startRule)
+
+    result, pos = self._scan(input)
+    if result is not Null and pos == len(input):
+      return result
+    # Во входе ошибка -- исключение получаем от полного парсера, чтобы оно
+    # в точности совпадало с исключением ValueElementContentParser-а. Полный
+    # парсер тоже разбирает списки без рекурсии, поэтому справляется с любой
+    # вложенностью.
+    return self._context()._parseWithDiagnostics(input, 'value')
+
+  def parse_many(self, inputs, processes = None):
+    if _usesPool(processes):
+      return parseInPool(self, inputs, processes)
+    # Сканер вызывается напрямую, к parse обращаемся только за ошибкой.
+    scan = self._scan
+    results = []
+    for input in inputs:
+      result, pos = scan(input)
+      if result is Null or pos != len(input):
+        result = self.parse(input)
+      results.append(result)
+    return results
+
+  # Разбирает вход, не используя рекурсию: вложенные списки, разбор которых еще
+  # не закончен, хранятся в явном стеке, поэтому глубина вложенности ограничена
+  # только памятью.
+  #
+  # Возвращает кортеж (разобранное_значение, позиция_после_значения). Если значение
+  # разобрать не удалось, вместо значения возвращается Null, а позиция указывает
+  # на место ошибки.
+  # Как и в исходной грамматике, пробельные символы перед запятой допустимы только
+  # после первого элемента списка.
+  def _scan(self, input):
+    match = self.re_value.match
+    ws = self.re_ws.match
+    stack = []
+    pos = 0
+    while True:
+      m = match(input, pos)
+      if m is None:
+        return Null, pos
+      kind = m.lastindex
+      pos = m.end()
+      if kind == 1:
+        pos = ws(input, pos).end()
+        if input[pos:pos+1] != '}':
+          # Непустой список -- переходим к разбору его первого элемента.
+          stack.append([])
+          continue
+        value = []
+        pos += 1
+      elif kind == 2:
+        # Пустая строка у ValueElementContentParser-а всегда str, даже для unicode-входа.
+        value = m.group(2) or ''
+      elif kind == 3:
+        value = int(m.group(3), 10)
+      elif kind == 4:
+        value = self.literals[m.group(4)]
+      else:
+        value = self._unescape(m.group(5))
+
+      # Значение разобрано: добавляем его в объемлющий список и закрываем
+      # все списки, которые на нем заканчиваются.
+      while stack:
+        current = stack[-1]
+        current.append(value)
+        if len(current) == 1:
+          pos = ws(input, pos).end()
+        if input[pos:pos+1] == ',':
+          pos = ws(input, pos+1).end()
+          break
+        pos = ws(input, pos).end()
+        if input[pos:pos+1] != '}':
+          return Null, pos
+        pos += 1
+        value = stack.pop()
+      else:
+        return value, pos
+
+  @classmethod
+  def _unescape(cls, s):
+    if not s:
+      return ''
+    return cls.re_escape.sub(cls._unescapeChar, s)
+  @staticmethod
+  def _unescapeChar(m):
+    ch = m.group(1)
+    if len(ch) == 4:
+      return unichr(int(ch, 16))
+    return ch
+
+
+# Разборщик содержимого элементов VALUE через стандартный декодер JSON.
+#
+# Грамматика значений почти совпадает с JSON, поэтому содержимое за один линейный
+# проход переводится в JSON (списки {} становятся [], экранированные символы
+# раскрываются) и декодируется модулем json, основная часть которого написана на C.
+# Декодер создается один раз на все разбираемые строки: json.loads с параметрами
+# создает новый декодер при каждом вызове, что в несколько раз дольше самого
+# декодирования короткой строки.
+# Строки в результате всегда unicode, в остальном результат совпадает с результатом
+# ValueElementContentParser-а.
+#
+# Там, где грамматики расходятся (пробельные символы перед запятой, пробельные
+# символы вокруг значения, ведущие нули в числах, минус перед строкой), а также
+# при любой ошибке вход разбирается ValueElementContentScanner-ом, поэтому
+# результат и исключения те же, что у него.
+class ValueElementContentJSONParser(ValueElementContentScanner):
+  # Делит вход на части вне строк (четные) и строки (нечетные).
+  re_split   = re.compile(r'("(?:[^"\\]|\\.)*")', re.S)
+  # Допустимое содержимое частей вне строк. Пробельные символы перед запятой
+  # допустимы не везде, поэтому такой вход разбирается сканером.
+  re_outside = re.compile(r'(?:[{},0-9-]|null|true|false|[ \t\r\n]+(?!,))*\Z')
+  whitespace = ' \t\r\n'
+
+  braces    = {ord(u'{'): u'[', ord(u'}'): u']'}
+  bracesStr = ''.join(map(chr, range(256))).replace('{', '[').replace('}', ']')
+  # Декодирует одно значение JSON с указанной позиции и возвращает пару (значение,
+  # позиция после него). strict=False разрешает управляющие символы внутри строк.
+  jsonScan  = json.JSONDecoder(strict=False).scan_once
+
+  def parse(self, input, startRule = None):
+    if startRule is None or startRule == 'value':
+      result = self._decode(input)
+      if result is not Null:
+        return result
+    return super(ValueElementContentJSONParser, self).parse(input, startRule)
+
+  def parse_many(self, inputs, processes = None):
+    if _usesPool(processes):
+      return parseInPool(self, inputs, processes)
+    decode = self._decode
+    parse = super(ValueElementContentJSONParser, self).parse
+    results = []
+    for input in inputs:
+      result = decode(input)
+      if result is Null:
+        result = parse(input)
+      results.append(result)
+    return results
+
+  # Возвращает результат декодирования или Null, если вход нужно разобрать сканером.
+  def _decode(self, input):
+    if not input or input[0] in self.whitespace or input[-1] in self.whitespace:
+      return Null
+    match = self.re_outside.match
+    if isinstance(input, unicode):
+      braces = self.braces
+    else:
+      # Байтовые строки сканер возвращает как есть, без декодирования.
+      try:
+        input.decode('ascii')
+      except UnicodeDecodeError:
+        return Null
+      braces = self.bracesStr
+    parts = self.re_split.split(input)
+    for i in xrange(0, len(parts), 2):
+      if match(parts[i]) is None:
+        return Null
+      parts[i] = parts[i].translate(braces)
+    for i in xrange(1, len(parts), 2):
+      if '\\' in parts[i]:
+        parts[i] = self.re_escape.sub(self._jsonChar, parts[i][1:-1]).join('""')
+    text = ''.join(parts)
+    try:
+      # StopIteration означает, что значения в начале нет, а RuntimeError возникает
+      # при слишком глубокой вложенности списков.
+      result, end = self.jsonScan(text, 0)
+    except (StopIteration, ValueError, RuntimeError):
+      return Null
+    if end != len(text):
+      return Null
+    return result
+
+  # Экранированный символ вставляется в JSON как есть, если только это не
+  # кавычка или обратная косая черта.
+  @staticmethod
+  def _jsonChar(m):
+    ch = m.group(1)
+    if len(ch) == 4:
+      ch = unichr(int(ch, 16))
+    if ch == '"' or ch == '\\':
+      return '\\' + ch
+    return ch
+
+
+# Быстрый разбор самых распространенных видов содержимого элементов VALUE.
+#
+# Большая часть содержимого в проектах укладывается в несколько шаблонов:
+# скалярное свойство, свойство со списком строк и событие. Такое содержимое
+# распознается одним заранее скомпилированным регулярным выражением и собирается
+# сразу из его групп. Все остальное (пробельные символы, экранирование, другие
+# структуры) передается разборщику общей грамматики. Результат в обоих случаях
+# одинаков. Разборщик можно использовать из нескольких потоков, если это позволяет
+# разборщик общей грамматики; счетчики статистики при этом могут быть неточными.
+class ShapeParser(object):
+  # Строка, возможно, с экранированными символами (с группой для содержимого и без нее).
+  strGroup = r'"((?:[^"\\]|\\.)*)"'
+  strToken = r'"(?:[^"\\]|\\.)*"'
+  # {{{},<скаляр>}} или {{null,<скаляр>}}, где скаляр -- строка, число или литерал.
+  re_scalar  = re.compile(r'\{\{(\{\}|null),(?:%s|(-?[0-9]+)|(null|true|false))\}\}\Z' % strGroup, re.S)
+  # {{{},{"строка","строка",...}}}, в том числе пустой список.
+  re_strings = re.compile(r'\{\{\{\},\{(%s(?:,%s)*)?\}\}\}\Z' % (strToken, strToken), re.S)
+  re_string  = re.compile(strGroup, re.S)
+  # Событие: {{{},{"тип","экран",асинхронность,"фрейм","обработчик","скрипт"}}}.
+  re_event   = re.compile(r'\{\{\{\},\{%s,%s,(true|false),%s,%s,%s\}\}\}\Z' % ((strGroup,)*5), re.S)
+
+  literals = {'null': None, 'true': True, 'false': False}
+
+  def __init__(self, parser):
+    # Разборщик общей грамматики (любой объект с методами parse и parse_many).
+    self.parser = parser
+    self.clear()
+
+  def parse(self, input, startRule = None):
+    if startRule is not None:
+      return self.parser.parse(input, startRule)
+    result = self._decode(input)
+    if result is Null:
+      self.counts['general'] += 1
+      return self.parser.parse(input)
+    return result
+
+  def parse_many(self, inputs, processes = None):
+    results = []
+    # Индексы в results и строки, которые не подошли ни под один шаблон.
+    indexes = []
+    rest = []
+    for input in inputs:
+      result = self._decode(input)
+      if result is Null:
+        indexes.append(len(results))
+        rest.append(input)
+      results.append(result)
+    if rest:
+      self.counts['general'] += len(rest)
+      for i, result in zip(indexes, self.parser.parse_many(rest, processes)):
+        results[i] = result
+    return results
+
+  def clear(self):
+    # Количество строк, разобранных по каждому из шаблонов и общей грамматикой.
+    self.counts = {'scalar': 0, 'strings': 0, 'event': 0, 'general': 0}
+
+  def stats(self):
+    u"""Возвращает словарь с количеством разборов по каждому пути и долей быстрых разборов."""
+    stats = dict(self.counts)
+    total = sum(self.counts.itervalues())
+    fast = total - self.counts['general']
+    stats['coverage'] = total and float(fast) / total or 0.0
+    return stats
+
+  # Возвращает результат разбора, если строка подходит под один из шаблонов, иначе Null.
+  def _decode(self, input):
+    m = self.re_scalar.match(input)
+    if m is not None:
+      self.counts['scalar'] += 1
+      head = None
+      if m.group(1) == '{}':
+        head = []
+      if m.group(2) is not None:
+        return [[head, self._string(m.group(2))]]
+      if m.group(3) is not None:
+        return [[head, int(m.group(3), 10)]]
+      return [[head, self.literals[m.group(4)]]]
+
+    m = self.re_strings.match(input)
+    if m is not None:
+      self.counts['strings'] += 1
+      strings = m.group(1)
+      if strings is None:
+        return [[[], []]]
+      if '\\' not in strings:
+        # Строки не содержат кавычек, поэтому '","' может быть только разделителем.
+        return [[[], [s or '' for s in strings[1:-1].split('","')]]]
+      return [[[], map(self._string, self.re_string.findall(strings))]]
+
+    m = self.re_event.match(input)
+    if m is not None:
+      self.counts['event'] += 1
+      type, screen, isAsync, frame, handler, script = m.groups()
+      string = self._string
+      return [[[], [string(type), string(screen), isAsync == 'true', string(frame), string(handler), string(script)]]]
+    return Null
+
+  # Пустая строка у ValueElementContentParser-а всегда str, а экранированные
+  # символы заменяются так же, как в ValueElementContentScanner.
+  @staticmethod
+  def _string(s):
+    if '\\' in s:
+      return ValueElementContentScanner._unescape(s)
+    return s or ''
+
+
+# Обертка над разборщиком, приводящая все строки в результатах разбора к unicode.
+#
+# Разборщики сами по себе возвращают строки разных типов: ValueElementContentParser,
+# ValueElementContentScanner и шаблоны ShapeParser возвращают str для str-входа без
+# экранированных символов и unicode в остальных случаях, а ValueElementContentJSONParser --
+# всегда unicode. Поэтому за ShapeParser с JSON-разборщиком типы строк зависят еще и
+# от того, подошло ли содержимое под шаблон.
+# Результаты, в которых все строки unicode, не зависят ни от выбранного разборщика,
+# ни от типа разбираемой строки. Строки str считаются записанными в UTF-8.
+#
+# Результат изменяется на месте, поэтому разборщик должен возвращать новые списки
+# при каждом вызове (кэш ставится поверх обертки, а не под ней).
+class UnicodeParser(object):
+  def __init__(self, parser):
+    # Разборщик, результаты которого приводятся к unicode (любой объект с методами
+    # parse и parse_many).
+    self.parser = parser
+
+  def parse(self, input, startRule = None):
+    if startRule is not None:
+      return self.parser.parse(input, startRule)
+    return self.toUnicode(self.parser.parse(input))
+
+  def parse_many(self, inputs, processes = None):
+    return map(self.toUnicode, self.parser.parse_many(inputs, processes))
+
+  @staticmethod
+  def toUnicode(value):
+    u"""Заменяет во вложенных списках value все строки str на unicode и возвращает value."""
+    if type(value) is str:
+      return value.decode('utf-8')
+    if type(value) is not list:
+      return value
+    stack = [value]
+    while stack:
+      items = stack.pop()
+      for i, item in enumerate(items):
+        if type(item) is str:
+          items[i] = item.decode('utf-8')
+        elif type(item) is list:
+          stack.append(item)
+    return value
+
+
+# Кэш результатов разбора, ключом которого является разбираемая строка.
+#
+# Строки 'abc' и u'abc' равны и имеют одинаковый хэш, но разборщики (если они не
+# обернуты в UnicodeParser) возвращают для них результаты с разными типами строк,
+# поэтому в ключ входит и тип строки.
+#
+# Одинаковое содержимое элементов VALUE встречается в проекте тысячи раз, поэтому
+# каждая уникальная строка разбирается только один раз, а все ее копии получают
+# один и тот же результат. Результат является общим и не должен изменяться
+# получателем -- тот, кто собирается его менять, должен сделать себе копию.
+#
+# Размер кэша ограничен. Кэш хранит два поколения записей: новые записи и записи,
+# к которым обращались недавно, попадают в текущее поколение; когда оно
+# заполняется, прошлое поколение выбрасывается целиком, а текущее становится
+# прошлым. Это дает приближение к вытеснению давно не используемых записей (LRU)
+# без накладных расходов на учет порядка обращений.
+#
+# Кэш можно использовать из нескольких потоков: отдельные операции со словарями
+# атомарны, а при одновременном заполнении в худшем случае одно и то же содержимое
+# будет разобрано дважды. Счетчики статистики при этом могут быть неточными.
+class ParseCache(object):
+  def __init__(self, parser, maxSize = 10000):
+    # Разборщик, результаты которого кэшируются (любой объект с методом parse).
+    self.parser = parser
+    # Максимальное количество записей в кэше.
+    self.maxSize = maxSize
+    self.clear()
+
+  def parse(self, input, startRule = None):
+    if startRule is not None:
+      return self.parser.parse(input, startRule)
+    key = (type(input), input)
+    try:
+      result = self._current[key]
+      self.hits += 1
+      return result
+    except KeyError:
+      pass
+    try:
+      result = self._previous.pop(key)
+      self.hits += 1
+    except KeyError:
+      # Ошибки разбора не кэшируются, исключение просто уходит вызывающему.
+      result = self.parser.parse(input)
+      self.misses += 1
+    self._store(key, result)
+    return result
+
+  def parse_many(self, inputs, processes = None):
+    u"""
+    Разбирает все строки из inputs и возвращает список результатов в том же порядке.
+    Разборщику одним пакетом передаются только уникальные строки, которых нет в кэше.
+    """
+    results = []
+    # Отображение ключа строки, которой нет в кэше, на индексы ее вхождений в results.
+    missing = {}
+    for input in inputs:
+      key = (type(input), input)
+      try:
+        result = self._current[key]
+        self.hits += 1
+      except KeyError:
+        result = self._previous.pop(key, Null)
+        if result is Null:
+          missing.setdefault(key, []).append(len(results))
+        else:
+          self.hits += 1
+          self._current[key] = result
+      results.append(result)
+
+    if missing:
+      keys = list(missing)
+      self.misses += len(keys)
+      self.hits += sum(map(len, missing.itervalues())) - len(keys)
+      inputs = [key[1] for key in keys]
+      for key, result in zip(keys, self.parser.parse_many(inputs, processes)):
+        self._store(key, result)
+        for i in missing[key]:
+          results[i] = result
+    return results
+
+  def clear(self):
+    self._current = {}
+    self._previous = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def stats(self):
+    u"""Возвращает словарь со статистикой использования кэша."""
+    lookups = self.hits + self.misses
+    return {
+      'hits'     : self.hits,
+      'misses'   : self.misses,
+      'evictions': self.evictions,
+      'size'     : len(self._current) + len(self._previous),
+      'maxSize'  : self.maxSize,
+      'hitRatio' : lookups and float(self.hits) / lookups or 0.0,
+    }
+
+  def _store(self, key, result):
+    if len(self._current) >= (self.maxSize + 1) // 2:
+      self.evictions += len(self._previous)
+      self._previous = self._current
+      self._current = {}
+    self._current[key] = result
+
+
+# Пул процессов для параллельного разбора (см. parse_many разборщиков). При запуске
+# каждого процесса в нем один раз создается копия разборщика с той же конфигурацией,
+# поэтому один пул можно передавать во многие вызовы parse_many подряд, не запуская
+# процессы каждый раз заново. Пул закрывается методом close или по выходу из with.
+class ParserPool(object):
+  def __init__(self, parser, processes):
+    # Разборщик, копии которого разбирают строки в процессах пула.
+    self.parser = parser
+    self.processes = processes
+    self._pool = multiprocessing.Pool(processes, _initWorker, (parser,))
+
+  def parse_many(self, inputs):
+    inputs = list(inputs)
+    # Несколько частей на процесс, чтобы процессы загружались равномерно.
+    size = max(1, -(-len(inputs) // (self.processes * 4)))
+    chunks = [inputs[i:i+size] for i in xrange(0, len(inputs), size)]
+    results = []
+    for part, error in self._pool.map(_parseChunk, chunks):
+      if error is not None:
+        raise error
+      results.extend(part)
+    return results
+
+  def close(self):
+    self._pool.close()
+    self._pool.join()
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+
+# Возвращает True, если параметр processes метода parse_many требует разбора в пуле.
+def _usesPool(processes):
+  return isinstance(processes, ParserPool) or processes is not None and processes > 1
+
+# Разбирает строки inputs копиями parser в пуле процессов и возвращает список результатов
+# в том же порядке, что и inputs. processes -- количество процессов (пул создается только
+# на этот вызов) или уже созданный ParserPool.
+def parseInPool(parser, inputs, processes):
+  if isinstance(processes, ParserPool):
+    return processes.parse_many(inputs)
+  with ParserPool(parser, processes) as pool:
+    return pool.parse_many(inputs)
+
+# Разборщик процесса пула, задается при запуске процесса (см. ParserPool).
+_workerParser = None
+
+def _initWorker(parser):
+  global _workerParser
+  _workerParser = parser
+
+# Выполняется в процессе пула. Возвращает кортеж (результаты, None) или, если
+# разобрать часть не удалось, (None, исключение).
+def _parseChunk(inputs):
+  try:
+    return _workerParser.parse_many(inputs), None
+  except ParserError as e:
+    return None, e
@@ -0,0 +1,191 @@
+# -*- encoding: utf-8 -*-
+u"""
+Сравнение скорости разборщиков содержимого элементов VALUE на реальных данных.
+
+Собирает содержимое всех элементов VALUE из указанных конфигурационных XML-файлов
+(или из всех *.xml-файлов в указанных папках, рекурсивно), проверяет, что все
+разборщики дают одинаковый результат, и замеряет время разбора всего корпуса.
+
+Затем замеряет время обратного преобразования разобранного корпуса в строки
+(K3ABaseElement._toString) по сравнению с прежней рекурсивной реализацией,
+проверяя, что обе дают одинаковые строки, которые разбираются в исходные значения.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import timeit
+import xml.etree.ElementTree as ET
+
+import Parser
+import k3a
+
+# Сравниваемые разборщики: (название, функция создания разборщика). Первый является эталоном.
+ENGINES = (
+  ('peg',     Parser.ValueElementContentParser),
+  ('scanner', Parser.ValueElementContentScanner),
+  ('json',    Parser.ValueElementContentJSONParser),
+  ('shapes',  lambda: Parser.ShapeParser(Parser.ValueElementContentScanner())),
+)
+
+def processCommandLine():
+  parser = argparse.ArgumentParser(
+    description=u'Compares performance of VALUE content parsers on real K3A configuration files.'
+  )
+  parser.add_argument(
+    'paths',
+    nargs='+',
+    help=u'K3A configuration XML files or directories with them (searched recursively)'
+  )
+  parser.add_argument(
+    '-r', '--repeat',
+    type=int,
+    default=3,
+    help=u'number of timing runs, the best one is reported (default: %(default)s)'
+  )
+  return parser.parse_args()
+
+def xmlFiles(paths):
+  for path in paths:
+    if os.path.isdir(path):
+      for dir, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+          if f.lower().endswith('.xml'):
+            yield os.path.join(dir, f)
+    else:
+      yield path
+
+def loadCorpus(paths):
+  u"""Возвращает список строк с содержимым всех элементов VALUE из указанных файлов."""
+  corpus = []
+  for path in xmlFiles(paths):
+    for value in ET.parse(path).getiterator('VALUE'):
+      if value.text is not None:
+        corpus.append(value.text)
+  return corpus
+
+def check(corpus, engines):
+  u"""Возвращает список строк корпуса, на которых результаты разборщиков различаются."""
+  def result(parser, s):
+    try:
+      return parser.parse(s)
+    except Parser.ParserError as e:
+      return (type(e), e.args)
+
+  reference = engines[0][1]
+  diffs = []
+  for s in corpus:
+    expected = result(reference, s)
+    for name, parser in engines[1:]:
+      if result(parser, s) != expected:
+        diffs.append((name, s))
+  return diffs
+
+def measure(parser, corpus, repeat):
+  def run():
+    parse = parser.parse
+    for s in corpus:
+      try:
+        parse(s)
+      except Parser.ParserError:
+        pass
+  return min(timeit.repeat(run, number=1, repeat=repeat))
+
+# Прежняя реализация K3ABaseElement._toString, эталон для сравнения.
+def referenceToString(value, result):
+  if isinstance(value, list):
+    result.append('{')
+    it = iter(value)
+    try:
+      referenceToString(it.next(), result)
+      for e in it:
+        result.append(',')
+        referenceToString(e, result)
+    except StopIteration:
+      pass
+    result.append('}')
+  elif isinstance(value, int):
+    result.append(str(value).lower())
+  elif value is None:
+    result.append('null')
+  elif isinstance(value, (str, unicode)):
+    value = value.replace('\\', '\\\\')
+    value = value.replace('"', '\\"')
+    value = value.replace('\n', '\\000A')
+    value = value.replace('\t', '\\0009')
+    value = value.replace('&', '\\0026')
+    value = value.replace('<', '\\003C')
+    value = value.replace('>', '\\003E')
+    result.extend(('"', value, '"'))
+  else:
+    raise Exception(u'Unknown type: %s (for value %s)' % (type(value), value))
+
+SERIALIZERS = (
+  ('reference', referenceToString),
+  ('k3a',       k3a.K3ABaseElement._toString),
+)
+
+def toString(serialize, value):
+  result = []
+  serialize(value, result)
+  return ''.join(result)
+
+def checkRoundTrip(values, parser):
+  u"""
+  Возвращает список значений, для которых сериализаторы дают разные строки
+  или строка не разбирается parser-ом обратно в исходное значение.
+  """
+  diffs = []
+  for value in values:
+    strings = [toString(serialize, value) for name, serialize in SERIALIZERS]
+    if strings.count(strings[0]) != len(strings) or parser.parse(strings[0]) != value:
+      diffs.append(value)
+  return diffs
+
+def measureSerializer(serialize, values, repeat):
+  def run():
+    for value in values:
+      serialize(value, [])
+  return min(timeit.repeat(run, number=1, repeat=repeat))
+
+if __name__ == "__main__":
+  args = processCommandLine()
+  corpus = loadCorpus(args.paths)
+  engines = [(name, create()) for name, create in ENGINES]
+
+  print(u'Corpus: %d values, %d characters' % (len(corpus), sum(map(len, corpus))))
+  diffs = check(corpus, engines)
+  for name, s in diffs[:10]:
+    print(u'MISMATCH [%s]: %r' % (name, s))
+  if diffs:
+    print(u'%d mismatches total' % len(diffs))
+
+  base = None
+  for name, parser in engines:
+    t = measure(parser, corpus, args.repeat)
+    base = base or t
+    print(u'%-10s %8.3f s  x%.2f' % (name, t, base / t if t else float('inf')))
+    if isinstance(parser, Parser.ShapeParser):
+      stats = parser.stats()
+      print(u'           fast path coverage %.1f%% (%s)' % (stats.pop('coverage') * 100, stats))
+
+  reference = engines[0][1]
+  values = []
+  for s in corpus:
+    try:
+      values.append(reference.parse(s))
+    except Parser.ParserError:
+      pass
+  print(u'Round trip: %d values' % len(values))
+  diffs = checkRoundTrip(values, reference)
+  for value in diffs[:10]:
+    print(u'ROUND TRIP MISMATCH: %r' % (value,))
+  if diffs:
+    print(u'%d round trip mismatches total' % len(diffs))
+
+  base = None
+  for name, serialize in SERIALIZERS:
+    t = measureSerializer(serialize, values, args.repeat)
+    base = base or t
+    print(u'%-10s %8.3f s  x%.2f' % (name, t, base / t if t else float('inf')))
@@ -0,0 +1,176 @@
+# -*- encoding: utf-8 -*-
+u"""
+Микро-замеры разборщика и сериализатора содержимого элементов VALUE.
+
+Замеряет время одного вызова ValueElementContentParser.parse (и быстрого
+ValueElementContentScanner.parse), K3ABaseElement._toString, K3ABaseElement._escape
+и K3ADocument._parseDynamicFields на данных разного вида: маленькие скаляры,
+длинные строки с большим количеством экранированных символов, широкие списки
+и глубокая вложенность.
+
+Каждый случай сначала прогревается, затем выполняется сериями, длина которых
+подбирается так, чтобы серия шла не меньше заданного времени; берется лучшее
+время из нескольких серий. Результаты можно сохранить как эталонные (--save),
+а при следующих запусках сравнить с ними: если какой-то случай стал медленнее
+эталона больше, чем в заданное число раз, скрипт завершается с кодом 1.
+Эталоны зависят от машины, поэтому сравнивать имеет смысл только замеры,
+сделанные на одной и той же машине.
+
+Поэтому эталоны не хранятся в репозитории, а создаются на своей машине перед
+изменениями: python benchmark_micro.py --save (по умолчанию в benchmark_micro.json
+рядом со скриптом, файл исключен из git). Без файла эталонов сравнение невозможно,
+и скрипт завершается с кодом 2; случаи, для которых нет эталона, считаются
+непройденными, пока эталоны не будут сохранены заново.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import Parser
+import k3a
+
+# Папка скрипта: в ней по умолчанию хранятся эталоны, независимо от текущей папки.
+__DIR__ = os.path.dirname(os.path.abspath(__file__))
+
+def processCommandLine():
+  parser = argparse.ArgumentParser(
+    description=u'Runs micro-benchmarks of VALUE content parser and serializer and compares them with stored baselines.'
+  )
+  parser.add_argument(
+    'cases',
+    nargs='*',
+    help=u'names (or name prefixes) of cases to run (default: all)'
+  )
+  parser.add_argument(
+    '-b', '--baseline',
+    default=os.path.join(__DIR__, 'benchmark_micro.json'),
+    help=u'file with baseline timings, created with --save (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-s', '--save',
+    action='store_true',
+    help=u'store measured timings as new baselines instead of comparing with them'
+  )
+  parser.add_argument(
+    '-t', '--threshold',
+    type=float,
+    default=1.25,
+    help=u'fail when a case is slower than baseline by more than this ratio (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-r', '--repeat',
+    type=int,
+    default=5,
+    help=u'number of timing runs of each case, the best one is reported (default: %(default)s)'
+  )
+  parser.add_argument(
+    '--min-time',
+    dest='minTime',
+    type=float,
+    default=0.1,
+    help=u'minimal duration of one timing run in seconds (default: %(default)s)'
+  )
+  return parser.parse_args()
+
+# Входные данные разных видов: (название, содержимое элемента VALUE).
+def inputs():
+  return [
+    ('tiny',    '{{{},1}}'),
+    ('string',  '{{{},"Common\\\\ConfirmSurcharge.htm"}}'),
+    ('escapes', '{{{},"%s"}}' % ('if (a \\003C b \\0026\\0026 c \\003E d) { s = \\"x\\\\y\\"; }\\000A' * 200)),
+    ('wide',    '{{{},{%s}}}' % ','.join('"Item%d"' % i for i in xrange(2000))),
+    ('deep',    '{' * 100 + '"leaf"' + '}' * 100),
+  ]
+
+def cases():
+  u"""Возвращает список пар (название случая, функция без аргументов)."""
+  result = []
+  peg = Parser.ValueElementContentParser()
+  scanner = Parser.ValueElementContentScanner()
+  for name, content in inputs():
+    result.append(('parse.peg.'     + name, lambda content=content: peg.parse(content)))
+    result.append(('parse.scanner.' + name, lambda content=content: scanner.parse(content)))
+
+  toString = k3a.K3ABaseElement._toString
+  for name, content in inputs():
+    value = scanner.parse(content)
+    result.append(('toString.' + name, lambda value=value: toString(value, [])))
+
+  escape = k3a.K3ABaseElement._escape
+  for name, s in (
+    ('short',   'Common\\ConfirmSurcharge.htm'),
+    ('plain',   'abcdefghij' * 1000),
+    ('oneLess', 'abcdefghij' * 500 + '<' + 'abcdefghij' * 500),
+    ('escapes', 'if (a < b && c > d) { s = "x\\y"; }\n' * 200),
+  ):
+    result.append(('escape.' + name, lambda s=s: escape(s)))
+
+  document = k3a.K3ADocument(None, 'Document', None)
+  parseDynamicFields = k3a.K3ADocument._parseDynamicFields
+  for name, fields in (
+    ('few',  ['Amount=Amount', 'Caption=$Caption', 'Text="static"']),
+    ('many', ['Field%d=#Key%d' % (i, i) for i in xrange(1000)]),
+  ):
+    result.append(('documentFields.' + name, lambda fields=fields: parseDynamicFields(document, fields)))
+  return result
+
+def measure(f, repeat, minTime):
+  u"""Возвращает лучшее время одного вызова f в секундах."""
+  timer = timeit.Timer(f)
+  # Прогрев и подбор количества вызовов в серии.
+  number = 1
+  while timer.timeit(number) < minTime:
+    number *= 2
+  return min(timer.repeat(repeat, number)) / number
+
+def loadBaselines(path):
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+if __name__ == "__main__":
+  args = processCommandLine()
+  baselines = loadBaselines(args.baseline)
+  if baselines is None:
+    if not args.save:
+      print(u'No baselines in %s, run with --save first to create them' % args.baseline)
+      sys.exit(2)
+    baselines = {}
+  timings = {}
+  failures = []
+  missing = []
+  for name, f in cases():
+    if args.cases and not any(name.startswith(c) for c in args.cases):
+      continue
+    t = timings[name] = measure(f, args.repeat, args.minTime)
+    base = baselines.get(name)
+    if args.save:
+      print(u'%-24s %12.3f us' % (name, t * 1e6))
+      continue
+    if base is None:
+      missing.append(name)
+      print(u'%-24s %12.3f us  no baseline' % (name, t * 1e6))
+      continue
+    ratio = t / base
+    status = ratio > args.threshold and 'FAIL' or 'ok'
+    if status == 'FAIL':
+      failures.append(name)
+    print(u'%-24s %12.3f us  baseline %12.3f us  x%.2f  %s' % (name, t * 1e6, base * 1e6, ratio, status))
+
+  if args.save:
+    baselines.update(timings)
+    with open(args.baseline, 'w') as f:
+      json.dump(baselines, f, indent=2, sort_keys=True)
+    print(u'Baselines written to %s' % args.baseline)
+  else:
+    if missing:
+      print(u'%d case(s) without baseline, run with --save to add them: %s' % (len(missing), ', '.join(missing)))
+    if failures:
+      print(u'%d case(s) slower than baseline by more than x%.2f: %s' % (len(failures), args.threshold, ', '.join(failures)))
+    if missing or failures:
+      sys.exit(1)
@@ -0,0 +1,195 @@
+# -*- encoding: utf-8 -*-
+u"""
+Замер производительности загрузки, запросов и сохранения проектов K3A.
+
+Для каждого масштаба (по умолчанию 1x, 10x и 100x от базового размера) генерирует
+синтетический проект (см. generate.py) и замеряет время:
+
+  load     - загрузка проекта, K3AProject(path);
+  snapshot - загрузка того же проекта из заранее сохраненного снимка,
+             K3AProject(path, snapshot=...);
+  query    - запросы upgrade.showInfo по типам, именам, свойствам, событиям,
+             документам и списку всех объектов и извлечение свойства у всех
+             объектов одного типа (objectProps);
+  upgrade  - работа типичного обновления: изменение свойств, экранов событий
+             и переименование элементов;
+  save     - сохранение проекта, save(True).
+
+Результаты выводятся на экран и записываются в JSON-файл (по умолчанию
+benchmark_project.json рядом со скриптом, файл исключен из git), чтобы их можно
+было сравнивать между версиями на одной и той же машине.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import generate
+import k3a
+import upgrade
+
+# Папка скрипта: в ней по умолчанию сохраняются результаты, независимо от текущей папки.
+__DIR__ = os.path.dirname(os.path.abspath(__file__))
+
+def processCommandLine():
+  parser = argparse.ArgumentParser(
+    description=u'Measures load/query/upgrade/save times of synthetic K3A projects of different sizes.'
+  )
+  generate.addSizeArguments(parser, objects=10)
+  parser.add_argument(
+    '-x', '--scales',
+    type=int,
+    nargs='+',
+    default=[1, 10, 100],
+    help=u'project sizes as multipliers of the number of objects (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-r', '--repeat',
+    type=int,
+    default=3,
+    help=u'number of runs of each size, the best time of each phase is reported (default: %(default)s)'
+  )
+  parser.add_argument(
+    '--output',
+    default=os.path.join(__DIR__, 'benchmark_project.json'),
+    help=u'file for JSON results (default: %(default)s)'
+  )
+  parser.add_argument(
+    '--dir',
+    help=u'directory for generated and saved projects (default: temporary directory, removed at the end)'
+  )
+  return parser.parse_args()
+
+# Обновление, выполняющее типичные для обновлений изменения.
+class BenchmarkUpgrader(k3a.Upgrader):
+  def upgrade(self, project):
+    updated = []
+    for o in project.objects('CashDeposit', 'CashWithdrawal'):
+      o.properties['Property00'].value = 'Upgraded'
+      updated.append(o)
+    for o in project.objects('Menu'):
+      for e in o.events:
+        e.screen = e.screen.replace('Common\\', 'Screens\\')
+      o.renameProperty('Property01', 'RenamedProperty')
+      updated.append(o)
+    return (updated,)
+  def minVersion(self):
+    return ()
+  def maxVersion(self):
+    return (99,)
+
+# Аргументы upgrade.showInfo: по типам, по именам, по элементам и список всех объектов.
+def queries(project):
+  names = [o.name for o in project.objects()][::10]
+  return [
+    argparse.Namespace(types=list(generate.TYPES['CustomerApp']), names=None, props=None, events=None, docs=None),
+    argparse.Namespace(types=None, names=names, props=None, events=None, docs=None),
+    argparse.Namespace(types=None, names=None, props=['Property00', 'RenamedProperty'], events=None, docs=None),
+    argparse.Namespace(types=None, names=None, props=None, events=['Event00'], docs=['Document00']),
+    argparse.Namespace(types=[], names=None, props=None, events=None, docs=None),
+  ]
+
+def query(project):
+  for args in queries(project):
+    upgrade.showInfo(project, args, lambda o: None)
+  for prop, o in project.objectProps('CashDeposit', 'Property00'):
+    prop.value
+
+class Quiet(object):
+  u"""Подавляет вывод на экран внутри блока with."""
+  def __enter__(self):
+    self._stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+  def __exit__(self, *exc):
+    sys.stdout.close()
+    sys.stdout = self._stdout
+
+def timed(f, *args):
+  u"""Возвращает пару (результат f(*args), время выполнения в секундах)."""
+  start = time.time()
+  with Quiet():
+    result = f(*args)
+  return result, time.time() - start
+
+def projectStats(path):
+  u"""Возвращает количество и суммарный размер XML-файлов проекта."""
+  files = size = 0
+  for dir, dirs, names in os.walk(path):
+    for name in names:
+      if name.endswith('.xml'):
+        files += 1
+        size += os.path.getsize(os.path.join(dir, name))
+  return files, size
+
+def run(args, scale, root):
+  src = os.path.join(root, 'x%d' % scale)
+  dst = os.path.join(root, 'x%d-saved' % scale)
+  snapshot = os.path.join(root, 'x%d.snapshot' % scale)
+  objects = args.objects * scale
+  with Quiet():
+    generate.generateProject(src, 'Synthetic', objects, args.properties, args.events, args.documents)
+  files, size = projectStats(src)
+  with Quiet():
+    k3a.K3AProject(src, snapshot=snapshot)
+
+  best = {}
+  for i in xrange(args.repeat):
+    times = {}
+    project, times['load'] = timed(k3a.K3AProject, src)
+    ignored, times['snapshot'] = timed(lambda: k3a.K3AProject(src, snapshot=snapshot))
+    ignored, times['query'] = timed(query, project)
+    ignored, times['upgrade'] = timed(BenchmarkUpgrader().upgrade, project)
+    project.dir = dst
+    ignored, times['save'] = timed(project.save, True)
+    shutil.rmtree(dst)
+    for phase, t in times.iteritems():
+      best[phase] = min(best.get(phase, t), t)
+
+  result = {
+    'scale'     : scale,
+    'objects'   : objects,
+    'values'    : objects * (args.properties + args.events + args.documents),
+    'files'     : files,
+    'bytes'     : size,
+  }
+  result.update(best)
+  shutil.rmtree(src)
+  os.remove(snapshot)
+  return result
+
+if __name__ == "__main__":
+  args = processCommandLine()
+  root = args.dir or tempfile.mkdtemp(prefix='k3a-benchmark-')
+  results = []
+  try:
+    print(u'%6s %8s %10s %8s %8s %8s %8s %8s' % ('scale', 'objects', 'bytes', 'load', 'snapshot', 'query', 'upgrade', 'save'))
+    for scale in args.scales:
+      r = run(args, scale, root)
+      results.append(r)
+      print(u'%5dx %8d %10d %8.3f %8.3f %8.3f %8.3f %8.3f' % (
+        r['scale'], r['objects'], r['bytes'], r['load'], r['snapshot'], r['query'], r['upgrade'], r['save']
+      ))
+  finally:
+    if args.dir is None:
+      shutil.rmtree(root, True)
+
+  with open(args.output, 'w') as f:
+    json.dump({
+      'python'    : platform.python_version(),
+      'platform'  : platform.platform(),
+      'parameters': {
+        'objects'   : args.objects,
+        'properties': args.properties,
+        'events'    : args.events,
+        'documents' : args.documents,
+        'repeat'    : args.repeat,
+      },
+      'results'   : results,
+    }, f, indent=2, sort_keys=True)
+  print(u'Results written to %s' % args.output)
@@ -0,0 +1,249 @@
+# -*- encoding: utf-8 -*-
+u"""
+Генератор синтетических проектов K3A для замеров производительности.
+
+Создает файл проекта .k3a, файлы Common с объявлением объектов (ApplicationObjects),
+файлы конфигурации объектов уровней NETWORK и DEFAULT, MLS.Stores.xml и
+UserInterface. Количество объектов, свойств, событий и документов задается
+параметрами; содержимое элементов VALUE похоже на содержимое реальных проектов:
+пути к экранам, списки строк, длинные скрипты и шаблоны печати с символами,
+требующими экранирования.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import xml.etree.ElementTree as ET
+
+import k3a
+
+# .NET типы объектов каждого класса.
+TYPES = {
+  'CustomerApp'  : ('CashDeposit', 'CashWithdrawal', 'TxGeneralRequest', 'Menu', 'BalanceInquiry', 'PinChange', 'Transfer'),
+  'SupervisorApp': ('SupervisorMenu', 'CounterReport'),
+}
+PRINTERS = ('ReceiptPrinter', 'StatementPrinter', 'JournalPrinter')
+HANDLERS = ('NavigateAndCallHandler', 'CallHandler', 'RunScript')
+
+def processCommandLine():
+  parser = argparse.ArgumentParser(
+    description=u'Generates synthetic K3A project for performance measurements.'
+  )
+  parser.add_argument(
+    'path',
+    help=u'directory where project will be created (must not exist)'
+  )
+  parser.add_argument(
+    '-n', '--name',
+    default='Synthetic',
+    help=u'project name (default: %(default)s)'
+  )
+  addSizeArguments(parser, objects=100)
+  parser.add_argument(
+    '-s', '--seed',
+    type=int,
+    default=0,
+    help=u'random seed, the same seed gives the same project (default: %(default)s)'
+  )
+  return parser.parse_args()
+
+def addSizeArguments(parser, objects):
+  u"""Добавляет в parser опции с размерами генерируемого проекта, objects -- количество объектов по умолчанию."""
+  parser.add_argument(
+    '-o', '--objects',
+    type=int,
+    default=objects,
+    help=u'number of objects (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-p', '--properties',
+    type=int,
+    default=20,
+    help=u'number of properties of each object (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-e', '--events',
+    type=int,
+    default=5,
+    help=u'number of events of each object (default: %(default)s)'
+  )
+  parser.add_argument(
+    '-d', '--documents',
+    type=int,
+    default=2,
+    help=u'number of documents of each object (default: %(default)s)'
+  )
+
+def generateProject(path, name='Synthetic', objects=100, properties=20, events=5, documents=2, seed=0):
+  u"""
+  Создает в папке path синтетический проект K3A и возвращает полный путь к его файлу .k3a.
+
+  objects    - количество объектов проекта.
+  properties - количество свойств каждого объекта.
+  events     - количество событий каждого объекта.
+  documents  - количество документов каждого объекта.
+  seed       - начальное значение генератора случайных чисел.
+  """
+  rnd = random.Random(seed)
+  fullNames = objectNames(objects)
+  locations = ['Root\\%s\\%s' % tuple(n.split('.')[:2]) for n in fullNames]
+
+  root = ET.Element('K3A')
+  ET.SubElement(root, 'ProjectName').text = name
+  ET.SubElement(root, 'Version').text = '3'
+  k3aFile = os.path.join(path, name + '.k3a')
+  writeXml(root, k3aFile)
+
+  for level in (k3a.MLS.NETWORK, k3a.MLS.DEFAULT):
+    dir = os.path.join(path, 'Configuration')
+    if level == k3a.MLS.DEFAULT:
+      dir = os.path.join(dir, 'Defaults')
+
+    # Объявление объектов проекта.
+    writeConfigFile(os.path.join(dir, 'K3A.%s.Common.%s.xml' % (name, level)), [
+      ('K3A.%s.Common.Config.%s' % (name, level), [
+        ('ApplicationObjects',          fullNames),
+        ('ApplicationObjectLocations',  locations),
+        ('ImportedAssemblies',          ['TXSST.dll', 'Bin\\Custom.Extensions.dll']),
+      ]),
+    ])
+
+    # Объекты, сгруппированные по файлам: K3A.<проект>.<класс>.<тип>.<уровень>.xml.
+    files = {}
+    for fullName in fullNames:
+      # На уровне NETWORK переопределяется только часть объектов и часть их значений.
+      if level == k3a.MLS.NETWORK and rnd.random() < 0.3:
+        continue
+      values = objectValues(rnd, properties, events, documents)
+      if level == k3a.MLS.NETWORK:
+        values = [v for v in values if rnd.random() < 0.5]
+      fileName = '.'.join(fullName.split('.')[:2])
+      files.setdefault(fileName, []).append(('K3A.%s.%s.%s' % (name, fullName, level), values))
+    for fileName, namespaces in sorted(files.iteritems()):
+      writeConfigFile(os.path.join(dir, 'K3A.%s.%s.%s.xml' % (name, fileName, level)), namespaces)
+
+    # Хранилища MLS, имена пространств в этом файле не содержат уровня.
+    writeConfigFile(os.path.join(dir, 'MLS.Stores.xml'), [
+      ('K3A.%s.MLS.Stores.%s' % (name, store), [
+        ('Path',      '%s\\%s.xml' % (level, store)),
+        ('ReadOnly',  store == 'Local'),
+        ('Priority',  i),
+      ])
+      for i, store in enumerate(('Local', 'Network', 'Central'))
+    ])
+
+    writeConfigFile(os.path.join(dir, 'K3A.%s.UserInterface.%s.xml' % (name, level)), [
+      ('K3A.%s.UserInterface.Screens.%s' % (name, level), [
+        ('Screen%d' % i, screenPath(rnd)) for i in xrange(max(1, objects // 10))
+      ] + [
+        ('Languages', ['en-US', 'ru-RU', 'de-DE']),
+        ('Timeout',   rnd.randint(10, 120)),
+      ]),
+    ])
+  return k3aFile
+
+def objectNames(count):
+  u"""Возвращает список из count полных имен объектов вида <класс>.<тип>.<имя>."""
+  types = [(cls, type) for cls in sorted(TYPES) for type in TYPES[cls]]
+  names = []
+  for i in xrange(count):
+    cls, type = types[i % len(types)]
+    names.append('%s.%s.%s%d' % (cls, type, type, i))
+  return names
+
+def objectValues(rnd, properties, events, documents):
+  u"""Возвращает список пар (имя_элемента_VALUE, значение) для одного объекта."""
+  values = [('Property%02d' % i, propertyValue(rnd)) for i in xrange(properties)]
+  for i in xrange(events):
+    handler = rnd.choice(HANDLERS)
+    values.append(('_EventEvent%02d' % i, [
+      handler,
+      screenPath(rnd),
+      rnd.random() < 0.5,
+      rnd.choice(('', '', 'MainFrame')),
+      rnd.choice(('', 'OnCustom%d' % i)),
+      handler == 'RunScript' and script(rnd) or '',
+    ]))
+  for i in xrange(documents):
+    values.append(('DocumentDocument%02d' % i, [
+      ['Field%d=%s' % (j, rnd.choice(('"text"', 'Amount', '#Key', '$Caption'))) for j in xrange(rnd.randint(0, 6))],
+      rnd.choice(PRINTERS),
+      'Template',
+      '',
+      template(rnd),
+      '',
+      False,
+      script(rnd),
+      rnd.random() < 0.5,
+    ]))
+  return values
+
+def propertyValue(rnd):
+  r = rnd.random()
+  if r < 0.35:
+    return 'Value %d' % rnd.randint(0, 1000)
+  if r < 0.5:
+    return screenPath(rnd)
+  if r < 0.65:
+    return rnd.randint(-100, 100000)
+  if r < 0.75:
+    return rnd.random() < 0.5
+  if r < 0.8:
+    return None
+  if r < 0.95:
+    return ['Item%d' % i for i in xrange(rnd.randint(0, 8))]
+  return script(rnd)
+
+def screenPath(rnd):
+  return 'Common\\Screen%d.htm' % rnd.randint(0, 200)
+
+def script(rnd):
+  u"""Возвращает скрипт JavaScript со строками, кавычками и операторами сравнения."""
+  lines = []
+  for i in xrange(rnd.randint(5, 40)):
+    lines.append('\tif (amount%d > 0 && amount%d < limit) { display("Amount: " + amount%d); }' % (i, i, i))
+  return 'function handler(amount, limit) {\n%s\n}' % '\n'.join(lines)
+
+def template(rnd):
+  u"""Возвращает шаблон печати с разметкой."""
+  rows = ['<tr><td>Field%d</td><td>{Field%d} &amp; "quoted"</td></tr>' % (i, i) for i in xrange(rnd.randint(5, 30))]
+  return '<html>\n<table>\n%s\n</table>\n</html>' % '\n'.join(rows)
+
+def content(value):
+  u"""Возвращает содержимое элемента VALUE для значения value в новом стиле."""
+  result = []
+  k3a.K3ABaseElement._toString(value, result)
+  return '{{{},%s}}' % ''.join(result)
+
+def writeConfigFile(path, namespaces):
+  u"""Записывает файл конфигурации из списка пар (имя_NAMESPACE, список_пар_(имя_VALUE, значение))."""
+  root = ET.Element('TREESTORE')
+  ns = ET.SubElement(root, 'NAMESPACES')
+  for name, values in namespaces:
+    namespace = ET.SubElement(ns, 'NAMESPACE', {'Name': name})
+    for valueName, value in values:
+      ET.SubElement(namespace, 'VALUE', {'Name': valueName}).text = content(value)
+  writeXml(root, path)
+
+def writeXml(root, path):
+  dir = os.path.dirname(path)
+  if not os.path.exists(dir):
+    os.makedirs(dir)
+  k3a.indent(root)
+  ET.ElementTree(root).write(path, 'utf-8', True)
+
+if __name__ == "__main__":
+  args = processCommandLine()
+  if os.path.exists(args.path):
+    raise SystemExit(u'Path %s already exists' % args.path)
+  path = generateProject(
+    args.path,
+    args.name,
+    args.objects,
+    args.properties,
+    args.events,
+    args.documents,
+    args.seed
+  )
+  print(u'Generated %s' % path)
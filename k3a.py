@@ -6,18 +6,98 @@ __date__ ="$31.05.2013 13:15:03$"
 
 from abc import ABCMeta
 from abc import abstractmethod
+import copy_reg
+import cPickle  # Для снимков разобранных проектов
+import ctypes   # Для атомарной замены файлов в Windows (MoveFileEx)
+import gc
+import hashlib  # Для сравнения записываемых файлов с файлами на диске
 import itertools# Для итератора по свойствам, событиям и документам
+import mmap   # Для копирования неизмененных частей файлов при сохранении по месту
+import multiprocessing
 import sys
 import glob   # Для получения файла проекта, когда путь задан к папке
 import os
-import shutil # Для очистки папки, в которую сохраняется проект
+import re
+import shutil # Для копирования файлов, если жесткую ссылку создать нельзя
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 import xml.etree.ElementTree as ET
-
+from xml.parsers import expat
+
+from Parser import LineIndex
+from Parser import Null
+from Parser import ParseCache
+from Parser import ParserError
+from Parser import ParserPool
+from Parser import ShapeParser
+from Parser import UnicodeParser
+from Parser import ValueElementContentJSONParser
 from Parser import ValueElementContentParser
+from Parser import ValueElementContentScanner
 
 __SUPPORTED_K3A_VERSIONS__ = [3]
-
-__valueTagParser__ = ValueElementContentParser()
+# Версия формата снимков разобранных проектов (см. K3AProject._saveSnapshot).
+# Увеличивается при любом изменении состава атрибутов сохраняемых объектов.
+__SNAPSHOT_VERSION__ = 4
+# Первая строка файла снимка, за которой через пробел следует версия формата. По ней
+# снимок отличается от любого другого файла до того, как из файла что-либо
+# распаковывается через pickle.
+__SNAPSHOT_HEADER__ = 'K3A project snapshot'
+
+# Доступные разборщики содержимого элементов VALUE.
+#
+# Разборщик -- класс, экземпляр которого создается без аргументов и имеет методы:
+#   parse(input, startRule = None) - разбирает строку input (str или unicode);
+#   parse_many(inputs, processes = None) - разбирает список строк и возвращает список
+#     результатов в том же порядке; processes -- количество процессов или пул
+#     (Parser.ParserPool), в котором разбираются строки.
+# Для разбора в пуле экземпляр вместе с конфигурацией передается в процессы пула
+# через pickle.
+# Результат разбора -- вложенные списки, в которых {} записывается пустым списком,
+# null -- None, true/false -- bool, числа -- int, а строки -- str (в UTF-8) или
+# unicode. При каждом вызове должны возвращаться новые списки. Если содержимое
+# не соответствует грамматике, выбрасывается ParserError.
+#
+# Строки в результатах приводятся к unicode оберткой (см. makeValueParser), поэтому
+# с ней все разборщики дают одинаковый результат.
+VALUE_PARSERS = {
+  'peg'     : ValueElementContentParser,
+  'scanner' : ValueElementContentScanner,
+  'json'    : ValueElementContentJSONParser,
+}
+
+def makeValueParser(name):
+  u"""
+  Создает разборщик содержимого элементов VALUE по названию из VALUE_PARSERS.
+
+  Возвращаемый разборщик кэширует результаты, сначала пробует частые виды содержимого
+  (см. ShapeParser), а строки в результатах всегда возвращает в виде unicode.
+  """
+  return ParseCache(UnicodeParser(ShapeParser(VALUE_PARSERS[name]())))
+
+# Результаты разбора одинакового содержимого разделяются всеми элементами.
+# Состояние разбора хранится отдельно для каждого вызова, поэтому разборщик
+# можно использовать одновременно из нескольких потоков.
+__valueTagParser__ = makeValueParser('scanner')
+__valueParserName__ = 'scanner'
+
+def setValueParser(name):
+  u"""Выбирает разборщик содержимого элементов VALUE по названию из VALUE_PARSERS."""
+  global __valueTagParser__, __valueParserName__
+  __valueTagParser__ = makeValueParser(name)
+  __valueParserName__ = name
+
+def makeValueParserPool(processes):
+  u"""
+  Создает пул из processes процессов, разбирающих содержимое элементов VALUE выбранным
+  разборщиком (см. setValueParser).
+
+  Пул передается в parseContents вместо количества процессов, чтобы при разборе
+  нескольких проектов подряд процессы не запускались каждый раз заново. После
+  использования пул закрывается методом close (или используется в операторе with).
+  """
+  return ParserPool(VALUE_PARSERS[__valueParserName__](), processes)
 
 
 class MLS:
@@ -28,6 +108,10 @@ class MLS:
 # не является допустимым значением перечисления.
 class ArgumentError(Exception):
   pass
+# Исключение, возбуждаемое K3AProject, если указанный для снимка файл не является
+# снимком проекта.
+class SnapshotError(Exception):
+  pass
 # Декоратор, при применении к методу-сеттеру свойства класса проверяет,
 # что устанавливаемое значение удовлетворяет ограничениям на допустимые значения.
 def enum(*restrictions):
@@ -56,41 +140,260 @@ def indent(elem, level=0):
     if level and (not elem.tail or not elem.tail.strip()):
       elem.tail = i
 
+# Символы, заменяемые при записи текста и значений атрибутов XML-элементов, и их
+# замены (те же, что и в ElementTree).
+__xmlTextEscapes__ = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'))
+__xmlAttribEscapes__ = __xmlTextEscapes__ + (('"', '&quot;'), ('\n', '&#10;'))
+
+def escapeXML(text, escapes=__xmlTextEscapes__):
+  u"""Экранирует text для записи в XML-файл и возвращает его в кодировке UTF-8."""
+  for ch, replacement in escapes:
+    if ch in text:
+      text = text.replace(ch, replacement)
+  if isinstance(text, unicode):
+    text = text.encode('utf-8', 'xmlcharrefreplace')
+  return text
+
+# Флаги MoveFileEx: заменять существующий файл и возвращать управление только после
+# того, как перемещение записано на диск.
+__MOVEFILE_REPLACE_EXISTING__ = 0x1
+__MOVEFILE_WRITE_THROUGH__ = 0x8
+
+def replaceFile(src, dst):
+  u"""
+  Переименовывает файл src в dst, атомарно заменяя существующий файл dst. В Windows
+  os.rename не заменяет существующий файл, поэтому там используется MoveFileEx.
+  """
+  if os.name != 'nt':
+    os.rename(src, dst)
+    return
+  encoding = sys.getfilesystemencoding()
+  if not isinstance(src, unicode):
+    src = src.decode(encoding)
+  if not isinstance(dst, unicode):
+    dst = dst.decode(encoding)
+  flags = __MOVEFILE_REPLACE_EXISTING__ | __MOVEFILE_WRITE_THROUGH__
+  if not ctypes.windll.kernel32.MoveFileExW(src, dst, flags):
+    raise ctypes.WinError()
+
+def linkFile(src, dst):
+  u"""
+  Создает жесткую ссылку dst на файл src, а если файловая система их не поддерживает,
+  копию файла src. В Windows в Python 2 нет os.link, поэтому там используется CreateHardLink.
+  """
+  try:
+    if os.name != 'nt':
+      os.link(src, dst)
+      return
+    encoding = sys.getfilesystemencoding()
+    if not isinstance(src, unicode):
+      src = src.decode(encoding)
+    if not isinstance(dst, unicode):
+      dst = dst.decode(encoding)
+    if not ctypes.windll.kernel32.CreateHardLinkW(dst, src, None):
+      raise ctypes.WinError()
+  except EnvironmentError:
+    shutil.copy2(src, dst)
+
+def replaceFiles(replacements):
+  u"""
+  Заменяет файлы по списку пар (временный_файл, файл) так, что заменяются либо все
+  файлы, либо ни один. На время замены прежний файл сохраняется рядом с ним под
+  именем <файл>.bak (жесткой ссылкой, см. linkFile), и если какой-либо файл заменить
+  не удалось, уже замененные файлы восстанавливаются, а файлы, которых раньше не
+  было, удаляются. Оставшиеся временные файлы при этом тоже удаляются, а в исключение
+  добавляется путь к файлу, который не удалось заменить.
+  """
+  # Пары (файл, сохраненный прежний файл или None, если его не было) для уже
+  # замененных файлов.
+  replaced = []
+  path = backup = None
+  try:
+    for temp, path in replacements:
+      backup = None
+      if os.path.exists(path):
+        backup = path + '.bak'
+        if os.path.exists(backup):
+          os.remove(backup)
+        linkFile(path, backup)
+      replaceFile(temp, path)
+      replaced.append((path, backup))
+  except Exception:
+    error = sys.exc_info()
+    # Файл, который не удалось заменить, остался прежним, и его копия не нужна.
+    if backup is not None and os.path.exists(backup):
+      os.remove(backup)
+    for replacedPath, replacedBackup in reversed(replaced):
+      try:
+        if replacedBackup is None:
+          os.remove(replacedPath)
+        else:
+          replaceFile(replacedBackup, replacedPath)
+      except EnvironmentError as e:
+        print(u'[Error] Cannot restore %s: %s' % (replacedPath, e))
+    # Замененные временные файлы уже не существуют.
+    for temp, p in replacements:
+      if os.path.exists(temp):
+        os.remove(temp)
+    # os.rename и MoveFileEx не указывают в ошибке, какой файл не удалось заменить.
+    if isinstance(error[1], EnvironmentError) and error[1].filename is None:
+      error[1].filename = path
+    raise error[0], error[1], error[2]
+  for path, backup in replaced:
+    if backup is not None:
+      os.remove(backup)
+
+def makeDirs(dir):
+  u"""Создает папку dir со всеми родительскими папками, если ее еще нет (в том числе из нескольких потоков)."""
+  if not os.path.isdir(dir):
+    try:
+      os.makedirs(dir)
+    except OSError:
+      if not os.path.isdir(dir):
+        raise
+
+def fileDigest(path):
+  u"""Возвращает хэш содержимого файла path или None, если файла нет."""
+  if not os.path.isfile(path):
+    return None
+  digest = hashlib.md5()
+  with open(path, 'rb') as f:
+    for data in iter(lambda: f.read(1 << 16), ''):
+      digest.update(data)
+  return digest.hexdigest()
+
+def withoutGC(f, *args):
+  u"""
+  Вызывает f(*args) с отключенным сборщиком мусора и возвращает результат. Нужно для
+  pickle: при создании множества объектов сборщик многократно обходит их все.
+  """
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return f(*args)
+  finally:
+    if enabled:
+      gc.enable()
+
 
 class NotImplementedException(Exception):
   pass
 
 # Список K3ABaseElement-ов, с возможностью получения их через индексацию
 # и доступ к свойству по имени.
+#
+# Для поиска по имени хранится индекс, отображающий имя на первый элемент с таким
+# именем. Он строится при первом поиске и сбрасывается при изменениях списка,
+# кроме добавления в конец, которое обновляет индекс сразу, а также при
+# переименовании любого элемента (см. K3ABaseElement.name).
 class Container(list):
+  # Индекс имен, None, если еще не построен.
+  _index = None
+  # Номер изменения списка, увеличивается при каждом изменении.
+  _version = 0
+  # Счетчик изменений проекта, в объект которого входит список (см. ChangeCounter),
+  # или None. Учитывает изменения состава списка, но не порядка элементов.
+  _counter = None
+  # Значение K3ABaseElement._renames на момент построения индекса.
+  _renames = None
+
   def __init__(self, iterable=[]):
     super(Container, self).__init__(iterable)
   def __getitem__(self, key):
     if isinstance(key, str):
-      for e in self:
-        if e.name == key: return e
+      e = self._find(key)
+      if e is not None: return e
     return super(Container, self).__getitem__(key)
   def __getattr__(self, key):
-    if isinstance(key, str):
-      for e in self:
-        if e.name == key: return e
+    # Специальные атрибуты (их ищут pickle и copy) не могут быть именами элементов.
+    if isinstance(key, str) and not key.startswith('__'):
+      e = self._find(key)
+      if e is not None: return e
     return super(Container, self).__getattr__(key)
+  # Индекс имен выводится из элементов, поэтому в снимки проектов (см.
+  # K3AProject._saveSnapshot) не попадает и после загрузки строится заново. Иначе его
+  # проверял бы счетчик K3ABaseElement._renames другого процесса.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('_index', None)
+    state.pop('_renames', None)
+    return state
+
+  def append(self, e):
+    super(Container, self).append(e)
+    self._version += 1
+    if self._counter is not None:
+      self._counter.count += 1
+    if self._index is not None:
+      self._index.setdefault(e.name, e)
+
+  # Оборачивает метод списка так, чтобы он сбрасывал индекс. reorders -- признак того,
+  # что метод только переставляет элементы и не меняет состав списка.
+  def _resetsIndex(method, reorders=False):
+    def wrapper(self, *args, **kwargs):
+      self._index = None
+      self._version += 1
+      if self._counter is not None and not reorders:
+        self._counter.count += 1
+      return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+  extend        = _resetsIndex(list.extend)
+  insert        = _resetsIndex(list.insert)
+  remove        = _resetsIndex(list.remove)
+  pop           = _resetsIndex(list.pop)
+  reverse       = _resetsIndex(list.reverse, True)
+  sort          = _resetsIndex(list.sort, True)
+  __setitem__   = _resetsIndex(list.__setitem__)
+  __delitem__   = _resetsIndex(list.__delitem__)
+  __setslice__  = _resetsIndex(list.__setslice__)
+  __delslice__  = _resetsIndex(list.__delslice__)
+  __iadd__      = _resetsIndex(list.__iadd__)
+  __imul__      = _resetsIndex(list.__imul__)
+  del _resetsIndex
+
+  def _find(self, name):
+    u"""Возвращает первый элемент с именем name или None, если такого нет."""
+    index = self._index
+    if index is None or self._renames != K3ABaseElement._renames:
+      index = {}
+      for e in self:
+        index.setdefault(e.name, e)
+      self._index = index
+      self._renames = K3ABaseElement._renames
+    return index.get(name)
 
 
 class K3ABaseElement(object):
   __metaclass__ = ABCMeta
+  # Количество переименований элементов. По нему Container узнает, что его индекс
+  # имен мог устареть.
+  _renames = 0
 
   def __init__(self, k3aObject, name, content):
     self._name = name
     self._object = k3aObject
-
-    # Содержимое элемента в виде строки.
-    self._content = None
-    # Содержимое элемента в виде разобранного содержимого
-    self._parsedContent = None
+    # Имя элемента на момент загрузки или последнего сохранения.
+    self._savedName = name
+    # Позиция элемента VALUE в файле, из которого он был загружен или в который
+    # последний раз сохранен, относительно начала его элемента NAMESPACE
+    # (см. ConfigFileReader), или None, если она неизвестна.
+    self._span = None
+
+    # Содержимое элемента в виде строки, в том виде, в каком оно было загружено.
+    self._content = content
+    # Содержимое элемента в виде разобранного содержимого. Содержимое разбирается
+    # при первом обращении к нему, до этого здесь хранится Null. Пока оно совпадает
+    # с _parsed, оно может быть общим для нескольких элементов (см. ParseCache)
+    # и не должно изменяться.
+    self._value = Null
+    # Разобранное содержимое _content (или Null, если оно еще не разобрано). Не
+    # изменяется: перед тем как отдать список наружу, _parsedContent заменяет _value
+    # копией, поэтому изменения по месту обнаруживаются сравнением _value с _parsed.
+    self._parsed = Null
     self._oldStyle = False
-
-    self._parseContent(content)
+    # Признак того, что содержимое было задано через один из сеттеров.
+    self._changed = False
     # print(u'  Create %s %s from %s' % (type(self), name, self._parsedContent))
   def __str__(self):
     return u'[%s] %s' % (type(self), self._name)
@@ -100,7 +403,19 @@ class K3ABaseElement(object):
     if other is None: return int(self is None)
     return cmp(self._name, other._name)
   def __getattr__(self, name):
+    # Служебные и специальные атрибуты в содержимом не ищутся: pickle и deepcopy
+    # запрашивают __setstate__ и т. п. у еще не заполненного элемента, и обращение
+    # к _parsedContent, которому нужен _value, снова приводило бы сюда.
+    if name.startswith('_'):
+      raise AttributeError(name)
     return self._parsedContent.__getattr__(name)
+  # То же, что и по умолчанию, но pickle и copy не ищут __getnewargs__, __getstate__ и
+  # __setstate__ каждого элемента через __getattr__: снимки проектов (см. K3AProject)
+  # содержат сотни тысяч элементов, и сохраняются и загружаются так почти вдвое быстрее.
+  def __reduce_ex__(self, protocol):
+    return copy_reg.__newobj__, (type(self),), self.__dict__
+  def __setstate__(self, state):
+    self.__dict__.update(state)
   def __getitem__(self, name):
     return self._parsedContent[name]
 ################################################################################
@@ -110,25 +425,125 @@ class K3ABaseElement(object):
   @name.setter
   def name(self, name):
     self._name = name
+    K3ABaseElement._renames += 1
+    if self._object is not None:
+      self._object._modified = True
+      self._object._countChange()
+  @property
+  def _parsedContent(self):
+    value = self._contentValue()
+    # Полученный список может быть изменен по месту, поэтому общий результат
+    # разбора заменяем своей копией.
+    if value is self._parsed and isinstance(value, list):
+      value = self._value = K3ABaseElement._copyValue(value)
+    return value
+  @_parsedContent.setter
+  def _parsedContent(self, value):
+    # Разбираем исходное содержимое, чтобы узнать его стиль.
+    self._contentValue()
+    self._value = value
+    self._markChanged()
+  def _markChanged(self):
+    self._changed = True
+    if self._object is not None:
+      self._object._modified = True
+  def _isChanged(self):
+    u"""Возвращает True, если разобранное содержимое могло измениться после разбора _content."""
+    return self._changed or not K3ABaseElement._sameValue(self._value, self._parsed)
 
 ################################################################################
   def asString(self):
+    if not self._isChanged():
+      return self._content
     result = []
     self._toString(self._parsedContent, result)
     if self._oldStyle:
       return ''.join(result)
     else:
       return '{{{},%s}}' % (''.join(result))
+  def hasChanges(self):
+    u"""
+    Возвращает True, если имя или содержимое элемента отличается от загруженного (или
+    последнего сохраненного). Измененное содержимое сравнивается в виде строки, так
+    как оно могло быть задано равным исходному.
+    """
+    if self._name != self._savedName:
+      return True
+    return self._isChanged() and self.asString() != self._content
+  def storedName(self):
+    u"""Возвращает имя элемента VALUE, в котором хранится элемент."""
+    return self._name
+  def _markSaved(self):
+    u"""Запоминает текущее имя и содержимое как сохраненные."""
+    self._savedName = self._name
+    if self._isChanged():
+      self._content = self.asString()
+      # _value мог быть получен снаружи и измениться по месту еще раз, поэтому
+      # сохраненное состояние запоминается копией.
+      self._parsed = K3ABaseElement._copyValue(self._value)
+      self._changed = False
+
+  # Копирование и сравнение разобранного содержимого. Вложенность списков в
+  # содержимом не ограничена, поэтому, как и _toString, они обходят списки без
+  # рекурсии (deepcopy и == на глубине в несколько тысяч возбуждают RuntimeError).
+  @staticmethod
+  def _copyValue(value):
+    u"""Возвращает копию value, в которой скопированы все вложенные списки."""
+    if not isinstance(value, list):
+      return value
+    result = list(value)
+    stack = [result]
+    while stack:
+      items = stack.pop()
+      for i, item in enumerate(items):
+        if isinstance(item, list):
+          items[i] = item = list(item)
+          stack.append(item)
+    return result
+  @staticmethod
+  def _sameValue(a, b):
+    u"""Возвращает то же, что и a == b, для вложенных списков a и b."""
+    stack = [(a, b)]
+    while stack:
+      a, b = stack.pop()
+      if a is b:
+        continue
+      if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+          return False
+        stack.extend(itertools.izip(a, b))
+      elif isinstance(a, list) or isinstance(b, list) or a != b:
+        return False
+    return True
+
+  @staticmethod
+  def parseContents(elements, processes=None):
+    u"""
+    Разбирает содержимое всех еще не разобранных элементов из elements одним пакетом.
+
+    processes - если больше 1, содержимое разбирается в пуле из указанного количества процессов.
+                Вместо количества можно передать пул из makeValueParserPool.
+    """
+    elements = [e for e in elements if e._value is Null]
+    parsed = __valueTagParser__.parse_many([e._content for e in elements], processes)
+    for e, parsedContent in itertools.izip(elements, parsed):
+      e._value = e._parsed = e._extractValue(parsedContent)
 
   def _parseContent(self, strContent):
     self._content = strContent
-    self._parsedContent = self._extractValue(__valueTagParser__.parse(strContent))
+    self._value = self._parsed = self._extractValue(__valueTagParser__.parse(strContent))
+
+  def _contentValue(self):
+    u"""Возвращает разобранное содержимое только для чтения, при необходимости разбирая его."""
+    if self._value is Null:
+      self._parseContent(self._content)
+    return self._value
 
   def _extract(self, index):
     try:
       # В старом формате хранения некоторые значения могут отсутствовать,
       # поэтому возможно исключение.
-      return self._parsedContent[index]
+      return self._contentValue()[index]
     except IndexError:
       pass
 
@@ -137,6 +552,7 @@ class K3ABaseElement(object):
       raise ArgumentError(u'Value must be one of %s, not %s' % (enum, value))
     if index >= 0:
       self._parsedContent[index] = value
+      self._markChanged()
     else:
       self._parsedContent = value
 
@@ -158,39 +574,74 @@ class K3ABaseElement(object):
     else:
       self._oldStyle = False
       return parsedContent[0][1]
+  # Символы, экранируемые в строках при записи, и их замены. Обратная косая черта
+  # должна заменяться первой.
+  escapes = (
+    ('\\', '\\\\'),
+    ('"' , '\\"'),
+    ('\n', '\\000A'),
+    ('\t', '\\0009'),
+    ('&' , '\\0026'),
+    ('<' , '\\003C'),
+    ('>' , '\\003E'),
+  )
+
   @staticmethod
   def _toString(value, result):
-    if isinstance(value, list):
-      result.append('{')
-      it = iter(value)
-      try:
-        K3ABaseElement._toString(it.next(), result)
-        for e in it:
-          result.append(',')
-          K3ABaseElement._toString(e, result)
-      except StopIteration:
-        pass
-      result.append('}')
-    elif isinstance(value, int):
-      result.append(str(value).lower())# lower для bool-значений, т.к. True и False являются int-ами.
-    elif value is None:
-      result.append('null')
-    elif isinstance(value, (str, unicode)):
-      result.append('"')
-      result.append(K3ABaseElement._escape(value))
-      result.append('"')
-    else:
-      raise Exception(u'Unknown type: %s (for value %s)' % (type(value), value))
+    # Дописывает в result части строкового представления value. Вложенные списки
+    # обходятся без рекурсии: в стеке хранятся итераторы по незаписанным элементам
+    # родительских списков.
+    append = result.append
+    escape = K3ABaseElement._escape
+    stack = []
+    it = iter((value,))
+    first = True
+    while True:
+      for value in it:
+        if not first:
+          append(',')
+        first = False
+        if isinstance(value, list):
+          append('{')
+          stack.append(it)
+          it = iter(value)
+          first = True
+          break
+        elif isinstance(value, (str, unicode)):
+          append('"')
+          append(escape(value))
+          append('"')
+        elif isinstance(value, int):
+          append(str(value).lower())# lower для bool-значений, т.к. True и False являются int-ами.
+        elif value is None:
+          append('null')
+        else:
+          raise Exception(u'Unknown type: %s (for value %s)' % (type(value), value))
+      else:
+        if not stack:
+          return
+        append('}')
+        it = stack.pop()
+        first = False
   @staticmethod
   def _escape(value):
-    value = value.replace('\\', '\\\\')
-    value = value.replace('"', '\\"')
-    value = value.replace('\n', '\\000A')
-    value = value.replace('\t', '\\0009')
-    value = value.replace('&', '\\0026')
-    value = value.replace('<', '\\003C')
-    value = value.replace('>', '\\003E')
-    return value;
+    # replace без совпадений возвращает исходную строку, а символ ищет через memchr,
+    # поэтому на длинных строках последовательные replace быстрее любой
+    # предварительной проверки.
+    if len(value) >= 256:
+      for ch, replacement in K3ABaseElement.escapes:
+        value = value.replace(ch, replacement)
+      return value
+    # На коротких строках (а их большинство) дешевле сначала проверить наличие
+    # символа оператором in. Замены те же, что в escapes, но без цикла.
+    if '\\' in value: value = value.replace('\\', '\\\\')
+    if '"'  in value: value = value.replace('"' , '\\"')
+    if '\n' in value: value = value.replace('\n', '\\000A')
+    if '\t' in value: value = value.replace('\t', '\\0009')
+    if '&'  in value: value = value.replace('&' , '\\0026')
+    if '<'  in value: value = value.replace('<' , '\\003C')
+    if '>'  in value: value = value.replace('>' , '\\003E')
+    return value
 
 class K3AProperty(K3ABaseElement):
 
@@ -207,7 +658,7 @@ class K3AProperty(K3ABaseElement):
     # * Список записывается, как значения в фигурных скобках.
   
   def __str__(self):
-    return u'%s=%s' % (self.name, self.value)
+    return u'%s=%s' % (self.name, self._contentValue())
 
   @property
   def value(self):
@@ -258,22 +709,23 @@ class K3AEvent(K3ABaseElement):
   @type.setter
   @enum('NavigateAndCallHandler', 'CallHandler', 'RunScript')
   def type(self, value):
-    self._parsedContent[0] = value
+    self._setValue(0, value)
   @screen.setter
   def screen(self, value):
-    self._parsedContent[1] = value
+    self._setValue(1, value)
   @isAsync.setter
   def isAsync(self, value):
-    self._parsedContent[2] = bool(value)
+    self._setValue(2, bool(value))
   @frame.setter
   def frame(self, value):
-    self._parsedContent[3] = value
+    self._setValue(3, value)
   @handlerName.setter
   def handlerName(self, value):
     try:
       self._parsedContent[4] = value
     except IndexError:
       self._parsedContent.append(value)
+    self._markChanged()
   @script.setter
   def script(self, value):
     try:
@@ -282,6 +734,7 @@ class K3AEvent(K3ABaseElement):
       if len(self._parsedContent) == 4:
         self._parsedContent.append('')
       self._parsedContent.append(value)
+    self._markChanged()
 
 class K3ADocument(K3ABaseElement):
   # Отображение (str=>str) placehoder-ов в документе на их значения.
@@ -326,10 +779,13 @@ class K3ADocument(K3ABaseElement):
     #   Depository
     #   Journal (галочка Копировать в журнал для него не доступна)
     #   BundleScanner
-    self._parseDynamicFields(self._extract(0))
+    # Разбирается при первом обращении.
+    self._fields = None
 
   @property
   def fields(self):
+    if self._fields is None:
+      self._parseDynamicFields(self._extract(0))
     return self._fields
   @property
   def printerType(self):
@@ -355,6 +811,9 @@ class K3ADocument(K3ABaseElement):
   @property
   def copyToJornal(self):
     return self._extract(8)
+
+  def storedName(self):
+    return 'Document%s' % self._name
   
   def _parseDynamicFields(self, fieldList):
     self._fields = dict()
@@ -364,11 +823,25 @@ class K3ADocument(K3ABaseElement):
       s = field.split('=')
       self._fields[s[0]] = s[1]
 
+# Счетчик изменений объектов одного проекта, от которых зависят его индексы для
+# запросов: переименований объектов и их элементов и изменений состава списков
+# элементов. Один экземпляр общий для всех объектов проекта и их списков элементов
+# (см. K3AObjectInfo._setCounter), поэтому изменения в других проектах индексы
+# не сбрасывают.
+class ChangeCounter(object):
+  def __init__(self):
+    self.count = 0
+
 # Соответствует одному элементу /TREESTORE/NAMESPACES/NAMESPACE в конфигурационных XML-файлах.
 class K3AObjectInfo(object):
+  # Счетчик изменений проекта, в который входит объект (ChangeCounter), или None.
+  _counter = None
+
   def __init__(self, namespace):
     # @type project K3AProject
-    # @type namespace ElementTree - Элемент TREESTORE.NAMESPACES.NAMESPACE
+    # @type namespace tuple - Элемент TREESTORE.NAMESPACES.NAMESPACE в виде пары
+    #                         (атрибут Name, список пар (Name, содержимое) элементов VALUE),
+    #                         см. readConfigFile
 
     # Массив из частей имени объекта.
     self._fullName = None
@@ -379,8 +852,22 @@ class K3AObjectInfo(object):
     self._events = None
     # Список (Container) документов объекта (K3ADocument).
     self._documents = None
+    # Признак того, что объект был переименован, или у него были переименованы
+    # или заменены элементы (см. hasChanges).
+    self._modified = False
+    # Версии списков элементов (Container._version) на момент загрузки или последнего сохранения.
+    self._savedVersions = None
+    # Полное имя объекта на момент загрузки или последнего сохранения.
+    self._savedFullName = None
+    # Элементы объекта на момент загрузки или последнего сохранения в порядке их
+    # следования в файле или None, если их позиции в файле неизвестны.
+    self._savedElements = None
+    # Позиция элемента NAMESPACE в файле, из которого объект был загружен или в который
+    # последний раз сохранен (см. ConfigFileReader), или None, если она неизвестна.
+    self._span = None
 
     self._parse(namespace)
+    self._markSaved()
   def __repr__(self):
     return 'K3AObjectInfo(class=%s, type=%s, name=%s, %s/%s/%s)' % (
       self.cls,
@@ -414,6 +901,8 @@ class K3AObjectInfo(object):
   def type(self, type):
     if len(self._fullName) == 3:
       self._fullName[1] = type
+      self._modified = True
+      self._countChange()
   # Имя объекта.
   @property
   def name(self):
@@ -421,6 +910,8 @@ class K3AObjectInfo(object):
   @name.setter
   def name(self, name):
     self._fullName[-1] = name
+    self._modified = True
+    self._countChange()
   @property
   def properties(self):
     return self._properties
@@ -431,32 +922,138 @@ class K3AObjectInfo(object):
   def documents(self):
     return self._documents
 ################################################################################
-  # parent - ElementTree.Element с именем 'NAMESPACE'
-  # level = NETWORK | DEFAULT
-  def write(self, parent, projectName, level):
-    # @type parent ElementTree
+  # Записывает в file элемент NAMESPACE с отступами, как у дерева, отформатированного indent.
+  # file - ConfigFileWriter.
+  # level = NETWORK | DEFAULT | None (в MLS.Stores уровень в имя не входит)
+  # Запоминается только позиция самого элемента NAMESPACE, позиции элементов VALUE
+  # при таком сохранении не запоминаются (см. K3AConfigFile._commit).
+  def write(self, file, projectName, level=None):
+    # @type file ConfigFileWriter
     # @type projectName str
     # @type level str
+    # При полной записи запоминается только позиция самого объекта: позиции сотен
+    # тысяч элементов заметно замедляют запись, а измененный объект при следующем
+    # сохранении по месту все равно записывается целиком (см. K3AConfigFile._commit).
+    file.write('    ')
+    self._writeNamespace(file, projectName, level, False)
+    file.write(file.newline)
+  def _writeNamespace(self, file, projectName, level, elementSpans=True):
+    u"""
+    Записывает элемент NAMESPACE без отступа перед ним и запоминает его новую позицию,
+    а если elementSpans равен True, то и позиции его элементов VALUE (см. ConfigFileWriter).
+    """
     # @type e K3ABaseElement
-    parent.set('Name', 'K3A.%s.%s.%s' % (projectName, self.fullName, level))
-
-    parent.append(ET.Comment('======== Properties ========'))
-    self._properties.sort()
-    for e in self._properties:
-      val = ET.SubElement(parent, 'VALUE', {'Name': e._name})
-      val.text = e.asString()
-
-    parent.append(ET.Comment('========== Events =========='))
-    self._events.sort()
-    for e in self._events:
-      val = ET.SubElement(parent, 'VALUE', {'Name': '_Event'+e._name})
-      val.text = e.asString()
-
-    parent.append(ET.Comment('========= Documents ========'))
-    self._documents.sort()
-    for e in self._documents:
-      val = ET.SubElement(parent, 'VALUE', {'Name': 'Document'+e._name})
-      val.text = e.asString()
+    newline = file.newline
+    valueXML = self._valueXML
+    parts = [self._namespaceStartTag(projectName, level), newline]
+    append = parts.append
+    # Пары (индекс в parts, элемент) для элементов VALUE.
+    values = []
+    for comment, items in self._categories():
+      append('      <!--%s-->%s' % (comment, newline))
+      items.sort()
+      for e in items:
+        append('      ')
+        if elementSpans:
+          values.append((len(parts), e))
+        append(valueXML(e))
+        append(newline)
+    append('    ')
+    start = file.offset
+    file.write(''.join(parts))
+    file.spans.append((self, (start, file.offset)))
+    file.write('</NAMESPACE>')
+    if elementSpans:
+      # Позиции частей относительно начала элемента NAMESPACE.
+      offsets = [0]
+      for part in parts:
+        offsets.append(offsets[-1] + len(part))
+      for i, e in values:
+        end = offsets[i + 1]
+        if parts[i].endswith('</VALUE>'):
+          end -= len('</VALUE>')
+        file.spans.append((e, (offsets[i], end)))
+  def _namespaceStartTag(self, projectName, level):
+    name = 'K3A.%s.%s' % (projectName, self.fullName)
+    if level is not None:
+      name += '.' + level
+    return '<NAMESPACE Name="%s">' % escapeXML(name, __xmlAttribEscapes__)
+  def _categories(self):
+    u"""Возвращает пары (комментарий, контейнер) в том порядке, в котором они сохраняются."""
+    return (
+      ('======== Properties ========', self._properties),
+      ('========== Events ==========', self._events),
+      ('========= Documents ========', self._documents),
+    )
+  @staticmethod
+  def _valueXML(e):
+    u"""Возвращает элемент VALUE для e."""
+    name = escapeXML(e.storedName(), __xmlAttribEscapes__)
+    text = e.asString()
+    if text:
+      return '<VALUE Name="%s">%s</VALUE>' % (name, escapeXML(text))
+    return '<VALUE Name="%s" />' % name
+  @classmethod
+  def _writeValue(cls, file, e):
+    u"""Записывает элемент VALUE для e и возвращает его позицию в записываемом файле (см. ConfigFileReader)."""
+    start = file.offset
+    value = cls._valueXML(e)
+    file.write(value)
+    if value.endswith('</VALUE>'):
+      return start, file.offset - len('</VALUE>')
+    return start, file.offset
+  def _patch(self, file, projectName, level):
+    u"""
+    Записывает в file (ConfigFileWriter, изменяющий исходный файл по месту) элемент
+    NAMESPACE объекта: из исходного файла копируются все элементы VALUE, кроме
+    измененных и удаленных, измененные записываются заново, а добавленные
+    дописываются после последнего элемента.
+    """
+    if not self.hasChanges():
+      # Объект копируется целиком, позиции его элементов относительно него не меняются.
+      file.spans.append((self, file.shifted(self._span)))
+      return
+    if self.fullName != self._savedFullName or not self._savedElements:
+      file.cut('NAMESPACE', self._span)
+      self._writeNamespace(file, projectName, level)
+      return
+    start = file.shifted(self._span)[0]
+    # Позиции элементов в исходном файле.
+    base = self._span[0]
+    absolute = lambda span: (base + span[0], base + span[1])
+    current = set(map(id, self))
+    for e in self._savedElements:
+      if id(e) not in current:
+        file.skip('VALUE', absolute(e._span))
+      elif e.hasChanges():
+        file.cut('VALUE', absolute(e._span))
+        s, end = self._writeValue(file, e)
+        file.spans.append((e, (s - start, end - start)))
+      else:
+        s, end = file.shifted(absolute(e._span))
+        file.spans.append((e, (s - start, end - start)))
+    saved = set(map(id, self._savedElements))
+    added = [e for e in self if id(e) not in saved]
+    if added:
+      file.copy(file.end('VALUE', absolute(self._savedElements[-1]._span)[1]))
+      for e in added:
+        file.write(file.newline + '      ')
+        s, end = self._writeValue(file, e)
+        file.spans.append((e, (s - start, end - start)))
+    file.spans.append((self, (start, file.shifted(self._span)[1])))
+
+  def parseContents(self, processes=None):
+    u"""Разбирает содержимое всех элементов объекта одним пакетом (см. K3ABaseElement.parseContents)."""
+    K3ABaseElement.parseContents(self, processes)
+  def hasChanges(self):
+    u"""
+    Возвращает True, если объект изменился с момента загрузки или последнего сохранения:
+    был переименован сам объект или его элементы, элементы были добавлены или удалены,
+    или изменилось содержимое какого-либо элемента.
+    """
+    if self._modified or self._savedVersions != self._versions():
+      return True
+    return any(e.hasChanges() for e in self)
 
   def dump(self, file=sys.stdout, indent=0):
     lvl = '  '*indent
@@ -491,13 +1088,22 @@ class K3AObjectInfo(object):
 ################################################################################
 # Приватная часть
 ################################################################################
+  def _setCounter(self, counter):
+    u"""Задает счетчик изменений проекта, в который входит объект, для него и его списков элементов."""
+    self._counter = counter
+    for items in (self._properties, self._events, self._documents):
+      items._counter = counter
+  def _countChange(self):
+    if self._counter is not None:
+      self._counter.count += 1
   def _parse(self, namespace):
-    self._parseNameAttribute(namespace.attrib['Name'])
+    name, values, self._span = namespace
+    self._parseNameAttribute(name)
     self._properties= Container()
     self._events    = Container()
     self._documents = Container()
-    for value in namespace.findall('VALUE'):
-      self._parseValueElement(value)
+    for name, content, span in values:
+      self._parseValueElement(name, content)._span = span
   def _parseNameAttribute(self, attr):
     attr = attr.split('.');
     # Структура:
@@ -512,15 +1118,33 @@ class K3AObjectInfo(object):
       self._fullName = attr[2:-1]
     else:
       self._fullName = attr[2:]
-  def _parseValueElement(self, value):
-    name = value.attrib['Name']
-
+  def _parseValueElement(self, name, content):
+    u"""Создает элемент для элемента VALUE, добавляет его в объект и возвращает его."""
     if name.startswith('_Event'):
-      self._events.append(K3AEvent(self, name[6:], value.text))# Пропускаем '_Event'
+      e = K3AEvent(self, name[6:], content)# Пропускаем '_Event'
+      self._events.append(e)
     elif name.startswith('Document'):
-      self._documents.append(K3ADocument(self, name[8:], value.text))# Пропускаем 'Document'
+      e = K3ADocument(self, name[8:], content)# Пропускаем 'Document'
+      self._documents.append(e)
+    else:
+      e = K3AProperty(self, name, content)
+      self._properties.append(e)
+    return e
+  def _versions(self):
+    return (self._properties._version, self._events._version, self._documents._version)
+  def _markSaved(self):
+    u"""Запоминает текущее состояние объекта как сохраненное."""
+    self._modified = False
+    self._savedVersions = self._versions()
+    self._savedFullName = self.fullName
+    elements = list(self)
+    for e in elements:
+      e._markSaved()
+    if self._span is not None and all(e._span is not None for e in elements):
+      elements.sort(key=lambda e: e._span[0])
+      self._savedElements = elements
     else:
-      self._properties.append(K3AProperty(self, name, value.text))
+      self._savedElements = None
 
 
 class K3AObject(object):
@@ -529,6 +1153,15 @@ class K3AObject(object):
     self._object  = obj
     # K3AObjectInfo
     self._default = None
+    # Отображение категории элементов ('properties', 'events', 'documents') на
+    # построенное для нее объединенное представление (см. __items).
+    self._views = {}
+  # Объединенные представления, как и индексы Container, в снимки проектов не
+  # попадают и после загрузки строятся заново.
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_views'] = {}
+    return state
   def __iter__(self):
     return itertools.chain(self.properties, self.events, self.documents)
   def __str__(self):
@@ -539,21 +1172,50 @@ class K3AObject(object):
   def __cmp__(self, other):
     return cmp(self.fullName, other.fullName)
   def __items(self, prop):
-    # Все элементы по умолчанию
+    # Объединенное представление строится заново, только если с момента построения
+    # изменились списки элементов объекта или умолчаний, было переименование
+    # какого-либо элемента или изменилось само представление.
+    default = own = None
     if self._default is not None:
-      items = Container(p for p in getattr(self._default, prop))
-    else:
-      items = Container()
+      default = getattr(self._default, prop)
     if self._object is not None:
-      for p in getattr(self._object, prop):
-        for i, pp in enumerate(items):
-          # Если объект имеет свой элемент, удаляем умолчание.
-          if pp.name == p.name:
-            del items[i]
-            break
+      own = getattr(self._object, prop)
+    state = (
+      K3ABaseElement._renames,
+      id(default), default is not None and default._version,
+      id(own), own is not None and own._version,
+    )
+    view = self._views.get(prop)
+    if view is not None:
+      # Исходные списки хранятся в view, поэтому их id не могут быть переиспользованы.
+      viewState, items, version, sources = view
+      if viewState == state and items._version == version:
+        return items
+
+    items = self.__merge(default, own)
+    self._views[prop] = (state, items, items._version, (default, own))
+    return items
+  @staticmethod
+  def __merge(default, own):
+    # Все элементы по умолчанию
+    items = []
+    if default is not None:
+      items.extend(default)
+    if own is not None:
+      # Отображение имени на индексы в items элементов с этим именем, по порядку.
+      positions = {}
+      for i, p in enumerate(items):
+        positions.setdefault(p.name, deque()).append(i)
+      for p in own:
+        indexes = positions.setdefault(p.name, deque())
+        # Если объект имеет свой элемент, удаляем первый элемент с тем же именем.
+        if indexes:
+          items[indexes.popleft()] = None
+        indexes.append(len(items))
         items.append(p)
+      items = [p for p in items if p is not None]
       items.sort(key=lambda p: p.name)
-    return items
+    return Container(items)
 ################################################################################
   def dump(self, file=sys.stdout):
     s = str(self)
@@ -646,12 +1308,198 @@ class K3AObject(object):
   def renameDocument(self, name, newName):
     return self.renameItem('documents', name, newName)
 
+# Последовательно разбирает конфигурационный XML-файл, собирая элементы
+# ./NAMESPACES/NAMESPACE и их элементы VALUE вместе с их позициями в файле.
+#
+# Позиция элемента -- пара смещений в байтах от начала файла: начала элемента и
+# места, о котором expat сообщает при его закрытии, то есть начала закрывающего тега
+# или, для пустого элемента (<VALUE Name="..." />), его конца (см. ConfigFileWriter.end).
+# Позиции элементов VALUE хранятся относительно начала их элемента NAMESPACE.
+class ConfigFileReader(object):
+  def __init__(self):
+    parser = self._parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = self._start
+    parser.EndElementHandler = self._end
+    parser.CharacterDataHandler = self._data
+    # Имена открытых элементов, от корня до текущего.
+    self._tags = []
+    # Читаемый элемент NAMESPACE: (атрибут Name, список VALUE, начало элемента).
+    self._namespace = None
+    # Читаемый элемент VALUE: (атрибут Name, начало элемента).
+    self._value = None
+    # Части содержимого читаемого элемента VALUE.
+    self._text = None
+    # Признак того, что текст сейчас относится к содержимому элемента VALUE.
+    self._collect = False
+    # Прочитанные элементы NAMESPACE в виде троек (атрибут Name, список троек
+    # (атрибут Name, содержимое, позиция) элементов VALUE, позиция).
+    self.namespaces = []
+
+  def feed(self, data, final=False):
+    try:
+      self._parser.Parse(data, final)
+    except expat.ExpatError as e:
+      # Выбрасываем то же исключение, что и ElementTree.
+      error = ET.ParseError(e)
+      error.code = e.code
+      error.position = e.lineno, e.offset
+      raise error
+
+  @staticmethod
+  def _fixText(text):
+    # Как и ElementTree, возвращаем строки из одних ASCII-символов в виде str.
+    try:
+      return text.encode('ascii')
+    except UnicodeError:
+      return text
+  def _start(self, tag, attrib):
+    tags = self._tags
+    tags.append(tag)
+    depth = len(tags)
+    # Содержимым элемента, как и в ElementTree, считается только текст до первого вложенного элемента.
+    self._collect = False
+    if depth == 3 and tag == 'NAMESPACE' and tags[1] == 'NAMESPACES':
+      self._namespace = (self._fixText(attrib['Name']), [], self._parser.CurrentByteIndex)
+    elif depth == 4 and tag == 'VALUE' and self._namespace is not None:
+      self._value = (self._fixText(attrib['Name']), self._parser.CurrentByteIndex)
+      self._text = []
+      self._collect = True
+  def _data(self, data):
+    if self._collect:
+      self._text.append(data)
+  def _end(self, tag):
+    tags = self._tags
+    depth = len(tags)
+    tags.pop()
+    if depth == 4 and self._value is not None:
+      name, start = self._value
+      base = self._namespace[2]
+      text = self._text and self._fixText(u''.join(self._text)) or None
+      self._namespace[1].append((name, text, (start - base, self._parser.CurrentByteIndex - base)))
+      self._value = self._text = None
+      self._collect = False
+    elif depth == 3 and self._namespace is not None:
+      name, values, start = self._namespace
+      self.namespaces.append((name, values, (start, self._parser.CurrentByteIndex)))
+      self._namespace = None
+
+def iterConfigFile(path):
+  u"""
+  Генератор, последовательно читающий конфигурационный XML-файл и возвращающий для
+  каждого элемента ./NAMESPACES/NAMESPACE тройку (атрибут Name, список троек
+  (атрибут Name, содержимое, позиция) его элементов VALUE, позиция) сразу, как только
+  элемент прочитан (см. ConfigFileReader).
+
+  В памяти одновременно находится только один элемент NAMESPACE, а не весь файл.
+  """
+  reader = ConfigFileReader()
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(1 << 16)
+      reader.feed(data, not data)
+      for namespace in reader.namespaces:
+        yield namespace
+      del reader.namespaces[:]
+      if not data:
+        break
+
+def readConfigFile(path):
+  u"""
+  Читает конфигурационный XML-файл и возвращает список его элементов NAMESPACE,
+  см. iterConfigFile. Результат состоит только из строк и чисел, поэтому его можно
+  передавать между процессами.
+  """
+  return list(iterConfigFile(path))
+
+def readConfigFiles(paths, workers, threads=False):
+  u"""
+  Читает конфигурационные файлы paths параллельно (см. readConfigFile) и возвращает
+  список их содержимого в том же порядке.
+
+  workers - количество процессов (или потоков) пула.
+  threads - если True, используется пул потоков, иначе пул процессов.
+  """
+  pool = (threads and ThreadPool or multiprocessing.Pool)(workers)
+  try:
+    return pool.map(readConfigFile, paths, 1)
+  finally:
+    pool.close()
+    pool.join()
+
+# Записывает конфигурационный XML-файл в file, считая хэш и количество записанных байт
+# и собирая новые позиции записанных элементов (см. ConfigFileReader).
+#
+# Если задан source -- содержимое исходного файла, файл изменяется по месту: части
+# исходного файла между измененными элементами копируются в file без изменений.
+class ConfigFileWriter(object):
+  def __init__(self, file, source=None):
+    # Файл, в который пишется содержимое, или None, если содержимое только хэшируется.
+    self._file = file
+    self.source = source
+    # Позиция в source, до которой он уже скопирован или пропущен.
+    self.pos = 0
+    # Количество записанных байт.
+    self.offset = 0
+    # Список пар (K3AObjectInfo или K3ABaseElement, новая позиция).
+    self.spans = []
+    self._digest = hashlib.md5()
+    # Перевод строки для новых строк: такой же, как первый перевод строки в исходном
+    # файле, чтобы в файле с CRLF не появлялись строки с LF.
+    self.newline = '\n'
+    if source is not None:
+      i = source.find('\n')
+      if i > 0 and source[i - 1] == '\r':
+        self.newline = '\r\n'
+
+  def write(self, data):
+    if self._file is not None:
+      self._file.write(data)
+    self._digest.update(data)
+    self.offset += len(data)
+  def digest(self):
+    u"""Возвращает хэш записанного содержимого (как fileDigest)."""
+    return self._digest.hexdigest()
+  def copy(self, upto):
+    u"""Копирует исходный файл до позиции upto."""
+    if upto > self.pos:
+      self.write(self.source[self.pos:upto])
+      self.pos = upto
+  def shifted(self, span):
+    u"""
+    Возвращает позицию в записываемом файле для позиции span исходного файла при
+    условии, что исходный файл до нее будет скопирован без изменений.
+    """
+    delta = self.offset - self.pos
+    return span[0] + delta, span[1] + delta
+  def end(self, tag, position):
+    u"""Возвращает конец элемента tag исходного файла по позиции его закрытия (см. ConfigFileReader)."""
+    close = '</' + tag
+    source = self.source
+    if source[position:position + len(close)] == close and \
+        source[position + len(close):position + len(close) + 1] in ('>', ' ', '\t', '\r', '\n'):
+      return source.find('>', position) + 1
+    return position
+  def cut(self, tag, span):
+    u"""Копирует исходный файл до начала элемента tag с позицией span и пропускает сам элемент."""
+    self.copy(span[0])
+    self.pos = self.end(tag, span[1])
+  def skip(self, tag, span):
+    u"""Пропускает элемент tag исходного файла с позицией span вместе с пробелами перед ним."""
+    start = span[0]
+    while start > self.pos and self.source[start - 1] in ' \t\r\n':
+      start -= 1
+    self.copy(start)
+    self.pos = self.end(tag, span[1])
+
 # Описывает конфигурационный XML-файл, содержащий список K3AObjectInfo.
 class K3AConfigFile(object):
-  def __init__(self, path, level):
+  def __init__(self, path, level, namespaces=None):
     u"""
     path - строка с полным путем к конфигурационному файлу.
     level - MLS.DEFAULT | MLS.NETWORK - строка с уровнем хранилища.
+    namespaces - уже прочитанное содержимое файла (см. readConfigFile). Если не задано,
+                 файл читается последовательно (см. iterConfigFile).
     """
     # @type path str
     # Путь, по которому был загружен данный файл.
@@ -660,9 +1508,16 @@ class K3AConfigFile(object):
     # Имя конфигурационного файла
     self._name = '.'.join(os.path.basename(self._path).split('.')[2:-2])
     # Список объектов K3AObjectInfo, найденных в этом файле.
-    self._objects = self._parse()
-    # Хранит признак того, что конфигурационный файл изменился и при записи его надо сохранить.
+    self._objects = self._parse(namespaces)
+    # Список объектов на момент загрузки или последнего сохранения.
+    self._savedObjects = list(self._objects)
+    # Хранит признак того, что путь к файлу изменился и при записи его надо сохранить.
     self._hasChanges = False
+    # Путь, размер и время изменения файла, к которому относятся позиции объектов и
+    # их элементов (см. _openSource).
+    self._source = self._stat(path)
+    # Хэш содержимого файла _source, если он известен (см. _diskDigest).
+    self._digest = None
 
   def __cmp__(self, other):
     if other is None: return int(self is None)
@@ -682,20 +1537,38 @@ class K3AConfigFile(object):
     self._hasChanges = self._hasChanges or self._path != value
     self._path = value
 ################################################################################
-  def save(self, projectName, force=False):
-    if not (self._hasChanges or force):
-      return
-    root = ET.Element('TREESTORE')
-    ns = ET.SubElement(root, 'NAMESPACES')
-
-    self._writeObjects(ns, projectName)
-
-    dir = os.path.dirname(self.path)
-    if not os.path.exists(dir):
-      os.makedirs(dir)
-    indent(root)
-    ET.ElementTree(root).write(self.path, 'utf-8', True)# Включаем XML-декларацию, для UTF-8 по умолчанию ее нет
-    self._path = self.path
+  def hasChanges(self):
+    u"""
+    Возвращает True, если файл нужно сохранить: изменился путь к нему, список его
+    объектов или какой-либо из объектов (см. K3AObjectInfo.hasChanges).
+    """
+    if self._hasChanges or len(self._objects) != len(self._savedObjects):
+      return True
+    for o, saved in itertools.izip(self._objects, self._savedObjects):
+      if o is not saved or o.hasChanges():
+        return True
+    return False
+  def save(self, projectName, force=False, patch=False):
+    u"""
+    Сохраняет файл, если он изменился (см. hasChanges) или force равен True.
+    Файл сначала записывается во временный файл, который затем заменяет собой
+    прежний, поэтому при ошибке записи прежний файл не портится. Если хэш записанного
+    содержимого совпадает с хэшем файла на диске, файл не заменяется и время его
+    изменения остается прежним.
+    Возвращает True, если файл был записан.
+
+    patch - если True и файл, из которого объекты были загружены (или в который
+            последний раз сохранены), с тех пор не изменялся, он изменяется по месту:
+            заново записываются только измененные, удаленные и добавленные элементы
+            VALUE и NAMESPACE, а остальное копируется из него байт в байт.
+    """
+    if not (force or self.hasChanges()):
+      return False
+    temp = self._writeTemp(projectName, patch)
+    if temp[0] is not None:
+      replaceFiles([(temp[0], self.path)])
+    self._commit(*temp[1:])
+    return temp[0] is not None
 
   def objects(self, *names):
     u"""
@@ -704,38 +1577,192 @@ class K3AConfigFile(object):
     """
     if len(names) == 0: return self._objects
     return [o for o in self._objects if o.name in names]
+  def parseContents(self, processes=None):
+    u"""Разбирает содержимое всех элементов всех объектов файла одним пакетом (см. K3ABaseElement.parseContents)."""
+    K3ABaseElement.parseContents(itertools.chain.from_iterable(self._objects), processes)
 ################################################################################
-  def _parse(self):
+  def _parse(self, namespaces):
     u"""
     Разбирает указанный файл, возвращает список K3AObjectInfo
     (соответсвующих элементам ./NAMESPACES/NAMESPACE), найденных в нем.
     """
-    # @type tree ElementTree
     # @type objects list
-    tree = ET.parse(self._path);
+    if namespaces is None:
+      namespaces = iterConfigFile(self._path)
     objects = []
-    for namespace in tree.findall('./NAMESPACES/NAMESPACE'):
+    for namespace in namespaces:
       objects.append(K3AObjectInfo(namespace))
     return objects
-  def _writeObjects(self, ns, projectName):
+  def _writeTemp(self, projectName, patch=False):
+    u"""
+    Записывает файл во временный файл рядом с ним и возвращает четверку (путь к временному
+    файлу, новые позиции объектов и элементов, True, если файл изменялся по месту, хэш
+    содержимого). Если файл на диске уже содержит то же самое, временного файла нет,
+    и вместо пути к нему возвращается None.
+    Состояние файла не изменяется, сохранение завершает _commit.
+
+    Содержимое пишется в файл по мере формирования и целиком в памяти не хранится.
+    Неизмененный файл (сохранение с force) скорее всего совпадает с файлом на диске,
+    поэтому его содержимое сначала только хэшируется, а временный файл записывается
+    вторым проходом, только если хэши различаются. Измененный файл сразу пишется во
+    временный файл, который удаляется, если хэш все же совпал.
+    """
+    diskDigest = self._diskDigest()
+    source = patch and self._openSource() or None
+    try:
+      if diskDigest is not None and not self.hasChanges():
+        file = self._render(None, source, projectName)
+        if file.digest() == diskDigest:
+          return None, file.spans, source is not None, diskDigest
+      makeDirs(os.path.dirname(self.path))
+      temp = self.path + '.tmp'
+      try:
+        with open(temp, 'wb', 1 << 16) as f:
+          file = self._render(f, source, projectName)
+        if file.digest() == diskDigest:
+          os.remove(temp)
+          temp = None
+      except:
+        if os.path.exists(temp):
+          os.remove(temp)
+        raise
+    finally:
+      if source is not None:
+        source.close()
+    return temp, file.spans, source is not None, file.digest()
+  def _render(self, f, source, projectName):
+    u"""
+    Записывает содержимое файла в f (если f равен None, содержимое только хэшируется)
+    и возвращает ConfigFileWriter с его хэшем и новыми позициями. Если задан source
+    (см. _openSource), файл изменяется по месту.
+    """
+    file = ConfigFileWriter(f, source)
+    if source is not None:
+      self._writePatched(file, projectName)
+    else:
+      # Документ пишется сразу в файл, без построения дерева ElementTree, но в том же
+      # виде: с XML-декларацией и отступами, как после indent.
+      file.write("<?xml version='1.0' encoding='utf-8'?>\n<TREESTORE>\n")
+      if self._objects:
+        file.write('  <NAMESPACES>\n')
+        self._writeObjects(file, projectName)
+        file.write('  </NAMESPACES>\n')
+      else:
+        file.write('  <NAMESPACES />\n')
+      file.write('</TREESTORE>\n')
+    return file
+  def _commit(self, spans, patched, digest):
+    u"""
+    Запоминает текущее состояние файла как сохраненное после того, как записанный
+    временный файл (см. _writeTemp), если он был, заменил собой файл.
+    """
+    if not patched:
+      # При полной записи запоминаются только позиции объектов (см. K3AObjectInfo.write),
+      # измененные объекты при следующем сохранении по месту записываются целиком.
+      for o in self._objects:
+        for e in o:
+          e._span = None
+    for x, span in spans:
+      x._span = span
+    self._source = self._stat(self.path)
+    self._digest = digest
+    self._markSaved()
+  def _openSource(self):
+    u"""
+    Возвращает содержимое (mmap) файла, к которому относятся позиции объектов, если
+    его можно изменить по месту: файл с тех пор не изменялся, а позиции всех
+    объектов известны. Иначе возвращает None.
+    """
+    if self._source is None or not self._savedObjects:
+      return None
+    if any(o._span is None for o in self._savedObjects):
+      return None
+    path = self._source[0]
+    if self._stat(path) != self._source:
+      return None
+    with open(path, 'rb') as f:
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  def _writePatched(self, file, projectName):
+    u"""Записывает файл, изменяя по месту исходный файл file.source (см. save)."""
+    # @type file ConfigFileWriter
+    level = self._nameLevel()
+    current = set(map(id, self._objects))
+    saved = sorted(self._savedObjects, key=lambda o: o._span[0])
+    for o in saved:
+      if id(o) in current:
+        o._patch(file, projectName, level)
+      else:
+        file.skip('NAMESPACE', o._span)
+    added = set(map(id, saved))
+    added = [o for o in self._objects if id(o) not in added]
+    if added:
+      file.copy(file.end('NAMESPACE', saved[-1]._span[1]))
+      for o in added:
+        file.write(file.newline + '    ')
+        o._writeNamespace(file, projectName, level)
+    file.copy(len(file.source))
+  def _diskDigest(self):
+    u"""
+    Возвращает хэш файла, который сейчас лежит по пути self.path, или None, если его нет.
+    Если это файл, записанный или пропущенный при последнем сохранении, и он с тех пор
+    не изменялся, файл не читается, а используется запомненный хэш.
+    """
+    stat = self._stat(self.path)
+    if stat is None:
+      return None
+    if stat == self._source and self._digest is not None:
+      return self._digest
+    return fileDigest(self.path)
+  @staticmethod
+  def _stat(path):
+    u"""Возвращает тройку (путь, размер, время изменения) для файла path или None, если его нет."""
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    if st.st_size == 0:
+      return None
+    return path, st.st_size, st.st_mtime
+  def _markSaved(self):
+    u"""Запоминает текущее состояние файла и его объектов как сохраненное."""
+    self._hasChanges = False
+    self._savedObjects = list(self._objects)
     for o in self._objects:
-      o.write(ET.SubElement(ns, 'NAMESPACE'), projectName, self._level)
+      o._markSaved()
+  def _writeObjects(self, file, projectName):
+    level = self._nameLevel()
+    for o in self._objects:
+      o.write(file, projectName, level)
+  def _nameLevel(self):
+    u"""Возвращает уровень, который входит в имена элементов NAMESPACE файла."""
+    return self._level
 
 class K3AMLSStoresConfigFile(K3AConfigFile):
-  def __init__(self, path, level):
-    super(K3AMLSStoresConfigFile, self).__init__(path, level)
+  def __init__(self, path, level, namespaces=None):
+    super(K3AMLSStoresConfigFile, self).__init__(path, level, namespaces)
     self._name = 'MLS.Stores'
-  def _writeObjects(self, ns, projectName):
-    for o in self._objects:
-      val = ET.SubElement(ns, 'NAMESPACE')
-      o.write(val, projectName, self._level)
-      val.set('Name', 'K3A.%s.%s' % (projectName, o.fullName))
+  def _nameLevel(self):
+    # В MLS.Stores уровень в имена не входит.
+    return None
 
 class K3AProject(object):
 
-  def __init__(self, path):
+  # Атрибуты, которые сохраняются в снимке разобранного проекта (см. _saveSnapshot).
+  _snapshotAttributes = (
+    '_path', '_name', '_version', '_assemblies', '_objects',
+    '_configFiles', '_mlsStoresConfigFiles', '_savedK3AFile', '_counter',
+  )
+
+  # snapshot - путь к файлу снимка разобранного проекта. Если снимок сделан для этого
+  # же проекта и его файлы с тех пор не изменялись, проект загружается из снимка,
+  # иначе разбирается заново и снимок перезаписывается (см. _loadSnapshot).
+  def __init__(self, path, valueParser=None, workers=None, threads=False, snapshot=None):
     # @type self K3AProject
     # @type path str
+    # @type valueParser str
+    # @type workers int
+    # @type threads bool
+    # @type snapshot str
 
     # Полный путь к папке, в которой лежит файл .k3a проекта.
     self._path = None;
@@ -745,19 +1772,45 @@ class K3AProject(object):
     self._version = None;
     # Список путей к дополнительным .NET-сборкам, используемых проектом.
     self._assemblies = None;
-    # Отображение имени объекта на K3AObject, содержащий настройки объекта
+    # Отображение полного имени объекта на K3AObject, содержащий настройки объекта
     # и настройки по умолчанию.
     self._objects = None;
+    # Индексы для запросов (см. query): отображение названия условия на словарь,
+    # отображающий значение на список K3AObject-ов с этим значением. Строятся при
+    # первом запросе и перестраиваются, если проект с тех пор изменился.
+    self._indexes = None;
+    # Счетчик изменений объектов проекта (ChangeCounter) и его значение, при котором
+    # были построены индексы (см. _queryIndexes).
+    self._counter = ChangeCounter();
+    self._indexesState = None;
     # Список со всеми файлами конфигурации проекта (K3AConfigFile).
     self._configFiles = None;
     # Список с файлами MLS.Stores.xml (K3AMLSStoresConfigFile).
     self._mlsStoresConfigFiles = None;
+    # Путь к файлу .k3a, имя и версия проекта на момент загрузки или последнего сохранения.
+    self._savedK3AFile = None;
+    # Если больше 1, файлы конфигурации читаются параллельно в пуле из указанного
+    # количества процессов (или потоков, если threads равен True).
+    self._workers = workers
+    self._threads = threads
+    # Отображение пути к файлу конфигурации на его заранее прочитанное содержимое.
+    self._preloaded = {}
+    # Список пар (путь, состояние) входных файлов проекта, которые проверялись при
+    # разборе, в том числе отсутствующих; первым идет файл .k3a (см. _checkInput).
+    self._inputs = []
+
+    # Разборщик содержимого элементов VALUE выбирается для всего модуля.
+    if valueParser is not None:
+      setValueParser(valueParser)
 
     print(u'Process path %s' % path)
     # Если переданный путь является папкой, берем первый файл из него.
     if os.path.isdir(path):
       path = glob.glob(os.path.join(path, '*.k3a'))[0]
-    self._parse(path)
+    if snapshot is None or not self._loadSnapshot(snapshot, path):
+      self._parse(path)
+      if snapshot is not None:
+        self._saveSnapshot(snapshot)
   def __repr__(self):
     return 'K3AProject(name=%s, path=%s, objects=%s)' % (self._name, self._path, len(self._objects))
 ################################################################################
@@ -811,41 +1864,173 @@ class K3AProject(object):
     Получает список объектов с указанными типами.
 
     types - список имен .NET типов, объекты которых нужно получить. Если не задано, то возвращаются все объекты.
+    Объекты, как и в query, отсортированы по полному имени.
     """
     if len(types) == 0:
-      return self._objects.values()
-    return [o for o in self._objects.itervalues() if o.type in types]
+      return self.query()
+    return self.query(types=types)
+  def object(self, fullName):
+    u"""Возвращает объект с указанным полным именем (<класс>.<тип>.<имя>) или None, если его нет."""
+    return self._objects.get(fullName)
+  def objectsByName(self, *names):
+    u"""Возвращает список объектов с указанными короткими именами (последняя часть полного имени)."""
+    return self.query(names=names)
   def objectProps(self, type, prop):
     u"""
     Возвращает генератор, который обходит все объекты проекта указанного типа type
     и извлекает из каждого свойство с именем prop (типа K3ABaseElement).
     """
-    for o in self._objects.itervalues():
-      if o.type == type:
-        yield o.properties[prop], o
+    for o in self.query(types=[type]):
+      yield o.properties[prop], o
+  def query(self, types=None, names=None, classes=None, props=None, events=None, docs=None):
+    u"""
+    Возвращает отсортированный по полному имени список объектов, удовлетворяющих
+    всем заданным условиям. Каждое условие -- список значений, объект удовлетворяет
+    ему, если совпадает хотя бы с одним из них. Если ни одно условие не задано,
+    возвращаются все объекты.
+
+    types   - .NET типы объектов.
+    names   - короткие имена объектов.
+    classes - классы объектов ('CustomerApp', 'SupervisorApp', ...).
+    props   - имена свойств, хотя бы одно из которых есть у объекта (собственное или по умолчанию).
+    events  - имена событий.
+    docs    - имена документов.
+
+    Поиск идет по индексам, поэтому время запроса пропорционально размеру результата.
+    """
+    indexes = self._queryIndexes()
+    result = None
+    for key, values in (
+      ('types',   types),
+      ('names',   names),
+      ('classes', classes),
+      ('props',   props),
+      ('events',  events),
+      ('docs',    docs),
+    ):
+      if values is None:
+        continue
+      index = indexes[key]
+      found = set()
+      for value in values:
+        found.update(index.get(value, ()))
+      result = found if result is None else result & found
+    if result is None:
+      return list(indexes[None])
+    return sorted(result, key=lambda o: o.fullName)
+  def parseContents(self, processes=None):
+    u"""
+    Разбирает содержимое всех элементов всех файлов конфигурации проекта одним пакетом,
+    вместо того, чтобы разбирать каждый элемент при первом обращении к нему.
 
-  def save(self, force=False, deleteUnusedFiles = False):
+    processes - если больше 1, содержимое разбирается в пуле из указанного количества процессов.
+                Вместо количества можно передать пул из makeValueParserPool.
+    """
+    confs = itertools.chain(self._mlsStoresConfigFiles, self._configFiles)
+    objects = itertools.chain.from_iterable(conf.objects() for conf in confs)
+    K3ABaseElement.parseContents(itertools.chain.from_iterable(objects), processes)
+
+  def save(self, force=False, deleteUnusedFiles = False, workers=None, patch=False):
     u"""
-    Сохраняет проект по пути self.dir.
+    Сохраняет проект по пути self.dir. Записываются только файлы, которые изменились
+    с момента загрузки или последнего сохранения (в том числе все файлы, если
+    изменилась папка или имя проекта). Файлы, новое содержимое которых совпадает
+    (по хэшу) с файлами, уже лежащими на диске, не перезаписываются, и время их
+    изменения остается прежним. Возвращает список путей к записанным файлам.
+
+    Все изменившиеся файлы сначала записываются во временные файлы рядом с ними и
+    заменяют собой прежние файлы только после того, как записаны все. Если при записи
+    или замене какого-либо файла произошла ошибка, временные файлы удаляются, а файлы
+    проекта остаются прежними (см. replaceFiles).
     
-    force - пересохранить даже не затронутые обновлением файлы (не реализовано).
-    deleteUnusedFiles - если True, папка конфигурации будет очищена перед сохранением.
+    force - пересохранить даже не затронутые обновлением файлы (если их содержимое
+            не изменилось, они только читаются для сравнения).
+    deleteUnusedFiles - если True, после сохранения из папки конфигурации удаляются
+            все файлы, кроме файлов проекта.
+    workers - если больше 1, файлы конфигурации записываются параллельно в пуле из
+              указанного количества потоков. Запись файлов в основном занимает
+              процессор, поэтому выигрыш есть только при медленном диске.
+    patch - если True, файлы конфигурации по возможности изменяются по месту: заново
+            записываются только измененные элементы, а остальное копируется из
+            исходных файлов байт в байт (см. K3AConfigFile.save).
     """
 
     if deleteUnusedFiles:
-      self._clearFolder(path)
-
-    self._saveK3AFile();
+      force = True
 
     for conf in self._mlsStoresConfigFiles:
       conf.path = os.path.join(self._levelToPath(conf._level), conf.name+'.xml')
-      conf.save(self.name, force)
-      print(u'[Saved] %s' % conf.path)
-
     for conf in self._configFiles:
       conf.path = self._pathToFile(conf.name, conf._level)
-      conf.save(self.name, force)
-      print(u'[Saved] %s' % conf.path)
+    confs = itertools.chain(self._mlsStoresConfigFiles, self._configFiles)
+    confs = [conf for conf in confs if force or conf.hasChanges()]
+
+    # Запись во временные файлы. Ошибки собираются, чтобы удалить временные файлы,
+    # записанные другими потоками.
+    def write(conf):
+      try:
+        return conf._writeTemp(self.name, patch), None
+      except Exception:
+        return None, sys.exc_info()
+    writeK3AFile = force or (self.k3aFile, self.name, self._version) != self._savedK3AFile
+    k3aTemp, error = None, None
+    try:
+      if writeK3AFile:
+        k3aTemp = self._writeK3AFile()
+    except Exception:
+      error = sys.exc_info()
+    if error is not None:
+      results = []
+    elif workers is not None and workers > 1 and len(confs) > 1:
+      pool = ThreadPool(workers)
+      try:
+        results = pool.map(write, confs, 1)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = map(write, confs)
+
+    temps = [temp[0] for temp, e in results if temp is not None]
+    errors = [e for temp, e in results if e is not None]
+    if error is not None or errors:
+      for temp in temps + [k3aTemp]:
+        if temp is not None and os.path.exists(temp):
+          os.remove(temp)
+      error = error or errors[0]
+      raise error[0], error[1], error[2]
+
+    # Все файлы записаны, заменяем ими прежние -- либо все, либо ни один.
+    replacements = []
+    if k3aTemp is not None:
+      replacements.append((k3aTemp, self.k3aFile))
+    for conf, (temp, e) in itertools.izip(confs, results):
+      if temp[0] is not None:
+        replacements.append((temp[0], conf.path))
+    replaceFiles(replacements)
+
+    # Состояние объектов отмечается сохраненным, только когда заменены все файлы.
+    saved = [path for temp, path in replacements]
+    for path in saved:
+      print(u'[Saved] %s' % path)
+    # Файлы, которые уже содержали то же самое.
+    skipped = []
+    if writeK3AFile:
+      if k3aTemp is None:
+        skipped.append(self.k3aFile)
+      self._savedK3AFile = (self.k3aFile, self.name, self._version)
+    for conf, (temp, e) in itertools.izip(confs, results):
+      conf._commit(*temp[1:])
+      if temp[0] is None:
+        skipped.append(conf.path)
+
+    if deleteUnusedFiles:
+      self._deleteUnusedFiles([conf.path for conf in itertools.chain(self._mlsStoresConfigFiles, self._configFiles)])
+    total = 1 + len(self._mlsStoresConfigFiles) + len(self._configFiles)
+    print(u'[Saved] %d of %d files, %d skipped (same content on disk), %d unchanged' % (
+      len(saved), total, len(skipped), total - len(saved) - len(skipped)
+    ))
+    return saved
 
   def dump(self, file=sys.stdout, detail=0):
     print(repr(self), file=file)
@@ -870,6 +2055,7 @@ class K3AProject(object):
     Разбирает файл *.k3a, который содержит имя проекта и версию конфигурации.
     """
     print(u'[Parse] K3A project file: %s' % path)
+    self._checkInput(os.path.abspath(path))
     tree = ET.parse(path)
     for name in tree.getiterator('ProjectName'):
       self._name = name.text
@@ -880,6 +2066,7 @@ class K3AProject(object):
 
     if self._version not in __SUPPORTED_K3A_VERSIONS__:
       print(u'WARNING: Project version (%s) do not match supported parser versions (%s), parse may be incorrect' % (self._version, __SUPPORTED_K3A_VERSIONS__))
+    self._savedK3AFile = (os.path.abspath(path), self._name, self._version)
   def _parseConfiguration(self):
     # @type objects list
     # Генератор частей имен файлов из имен объектов.
@@ -892,40 +2079,75 @@ class K3AProject(object):
     self._mlsStoresConfigFiles = []
     self._assemblies = []# Заполняется в _parseCommon
     self._objects = dict()
+    self._indexes = None
 
     # objects содержит список кортежей строк (имя_объекта, местоположение_объекта_в_дереве_дизайнера)
     objects = self._parseCommon(MLS.DEFAULT)
     objects.extend(self._parseCommon(MLS.NETWORK))
     # Удаляем дубликаты
     objects = set(objects)
-    objectFullNames = map(lambda x: x[0], objects)
+    objectFullNames = set(x[0] for x in objects)
 
     # Извлекаем части имен файлов из имен объектов, удаляем дубликаты и сортируем
     # для эстетического восприятия.
     fileNames = sorted(set(names(objects)))
+    if self._workers is not None and self._workers > 1:
+      self._preload(fileNames)
     for n in fileNames:
       conf = self._parseConfigFile(n, MLS.NETWORK)
       if conf is not None:
         for o in conf.objects():
           # Достаем только те объекты, которые есть в проекте
           if o.fullName in objectFullNames:
-            self._objects[o.name] = K3AObject(o)
+            o._setCounter(self._counter)
+            self._objects[o.fullName] = K3AObject(o)
 
     for n in fileNames:
       conf = self._parseConfigFile(n, MLS.DEFAULT)
       if conf is not None:
         for o in conf.objects():
           # Достаем только те объекты, которые есть в проекте
-          if o.fullName in objectFullNames:
+          fullName = o.fullName
+          if fullName in objectFullNames:
+            o._setCounter(self._counter)
             try:
               # @type obj K3AObject
-              obj = self._objects[o.name]
+              obj = self._objects[fullName]
             except KeyError:
-              self._objects[o.name] = obj = K3AObject(None)
+              self._objects[fullName] = obj = K3AObject(None)
             obj._default = o
 
     self._parseSpecialConfigs()
 
+  # Функции, возвращающие значения, по которым объект попадает в индексы запросов.
+  _indexKeys = {
+    'types'  : lambda o: (o.type,),
+    'names'  : lambda o: (o.name,),
+    'classes': lambda o: (o.cls,),
+    'props'  : lambda o: set(e.name for e in o.properties),
+    'events' : lambda o: set(e.name for e in o.events),
+    'docs'   : lambda o: set(e.name for e in o.documents),
+  }
+  def _queryIndexes(self):
+    u"""
+    Возвращает индексы для запросов, перестраивая их, если проект изменился. Под
+    ключом None в индексах хранится отсортированный по полному имени список всех объектов.
+    """
+    # Индексы зависят от имен и типов объектов, имен их элементов и состава их
+    # списков, изменения которых считает self._counter.
+    state = self._counter.count
+    if self._indexes is None or self._indexesState != state:
+      indexes = dict((key, {}) for key in self._indexKeys)
+      for o in self._objects.itervalues():
+        for key, keys in self._indexKeys.iteritems():
+          index = indexes[key]
+          for k in keys(o):
+            index.setdefault(k, []).append(o)
+      indexes[None] = sorted(self._objects.itervalues(), key=lambda o: o.fullName)
+      self._indexes = indexes
+      self._indexesState = state
+    return self._indexes
+
   @enum(MLS.DEFAULT, MLS.NETWORK)
   def _parseCommon(self, level):
     u"""
@@ -941,12 +2163,13 @@ class K3AProject(object):
     if conf is not None:
       for o in conf.objects('Config'):
         for p in o.properties:
+          # Значения только читаются, поэтому берем их, не помечая свойства измененными.
           if p.name == 'ApplicationObjects':
-            objectNames.extend(p.value)
+            objectNames.extend(p._contentValue())
           elif p.name == 'ApplicationObjectLocations':
-            objectLocations.extend(p.value)
+            objectLocations.extend(p._contentValue())
           elif p.name == 'ImportedAssemblies':
-            self._assemblies.extend(p.value)
+            self._assemblies.extend(p._contentValue())
           else:
             print('[Parse] <unknown>', p)
 
@@ -956,9 +2179,9 @@ class K3AProject(object):
     path = self._levelToPath(level)
     path = os.path.join(path, 'MLS.Stores.xml')
 
-    if os.path.exists(path):
+    if self._checkInput(path):
       print(u'[Parse] %s' % path)
-      conf = K3AMLSStoresConfigFile(path, level)
+      conf = K3AMLSStoresConfigFile(path, level, self._preloaded.pop(path, None))
       self._mlsStoresConfigFiles.append(conf)
       return conf
   def _parseConfigFile(self, configName, level):
@@ -969,9 +2192,9 @@ class K3AProject(object):
     """
     path = self._pathToFile(configName, level)
 
-    if os.path.exists(path):
+    if self._checkInput(path):
       print(u'[Parse] %s' % path)
-      conf = K3AConfigFile(path, level)
+      conf = K3AConfigFile(path, level, self._preloaded.pop(path, None))
       self._configFiles.append(conf)
       return conf
   def _parseSpecialConfigs(self):
@@ -984,20 +2207,148 @@ class K3AProject(object):
 
     self._parseConfigFile('WebOperator', MLS.DEFAULT)
     self._parseConfigFile('WebOperator', MLS.NETWORK)
-    
+  def _preload(self, fileNames):
+    u"""
+    Параллельно читает все файлы конфигурации, которые затем по одному разбираются
+    в _parseConfiguration и _parseSpecialConfigs. Объекты проекта по-прежнему
+    создаются в том же порядке, что и без предварительного чтения.
+    """
+    paths = [self._pathToFile(n, MLS.NETWORK) for n in fileNames]
+    paths.extend(self._pathToFile(n, MLS.DEFAULT) for n in fileNames)
+    # Те же файлы и в том же порядке, что и в _parseSpecialConfigs.
+    paths.append(os.path.join(self._levelToPath(MLS.DEFAULT), 'MLS.Stores.xml'))
+    paths.append(os.path.join(self._levelToPath(MLS.NETWORK), 'MLS.Stores.xml'))
+    for name in ('UserInterface', 'WebOperator'):
+      paths.append(self._pathToFile(name, MLS.DEFAULT))
+      paths.append(self._pathToFile(name, MLS.NETWORK))
+
+    paths = [p for p in paths if os.path.exists(p)]
+    print(u'[Parse] Read %d configuration files with %d workers' % (len(paths), self._workers))
+    self._preloaded = dict(zip(paths, readConfigFiles(paths, self._workers, self._threads)))
+  def _checkInput(self, path):
+    u"""
+    Запоминает состояние входного файла проекта path для снимка (см. _saveSnapshot)
+    и возвращает True, если файл существует.
+    """
+    stat = self._fileStat(path)
+    self._inputs.append((path, stat))
+    return stat is not None
+  @staticmethod
+  def _fileStat(path):
+    u"""Возвращает пару (размер, время изменения) файла path или None, если его нет."""
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return st.st_size, st.st_mtime
+################################################################################
+  def _loadSnapshot(self, snapshot, path):
+    u"""
+    Загружает проект из снимка snapshot, если он сделан для файла проекта path и с тех
+    пор ни один из входных файлов проекта не изменился: совпадают размеры, времена
+    изменения и хэши всех файлов, а отсутствовавшие файлы по-прежнему отсутствуют.
+    Возвращает True, если проект загружен из снимка.
+
+    Если файл snapshot не является снимком (не начинается с __SNAPSHOT_HEADER__), он
+    не читается и не перезаписывается, а возбуждается SnapshotError.
+    """
+    if not os.path.exists(snapshot):
+      return False
+    with open(snapshot, 'rb') as f:
+      header = f.readline(len(__SNAPSHOT_HEADER__) + 16)
+    if header.startswith(__SNAPSHOT_HEADER__ + ' '):
+      version = header[len(__SNAPSHOT_HEADER__):].strip()
+    elif header.startswith('\x80'):
+      # Снимки до версии 4 не имели заголовка и начинались сразу с pickle.
+      version = u'< 4'
+    else:
+      raise SnapshotError(u'%s is not a project snapshot' % snapshot)
+    if version != str(__SNAPSHOT_VERSION__):
+      print(u'[Snapshot] %s has format version %s, but version %s is supported' % (snapshot, version, __SNAPSHOT_VERSION__))
+      return False
+    try:
+      with open(snapshot, 'rb') as f:
+        f.readline()
+        inputs = cPickle.load(f)
+        if inputs[0][0] != os.path.abspath(path):
+          print(u'[Snapshot] %s is made for other project' % snapshot)
+          return False
+        if not self._inputsUnchanged(inputs):
+          print(u'[Snapshot] %s is out of date' % snapshot)
+          return False
+        state = withoutGC(cPickle.loads, f.read())
+    except Exception as e:
+      # Поврежденный или несовместимый снимок просто не используется.
+      print(u'[Snapshot] Cannot load %s: %r' % (snapshot, e))
+      return False
+    self.__dict__.update(state)
+    self._inputs = [(p, stat) for p, stat, digest in inputs]
+    print(u'[Snapshot] Loaded %s' % snapshot)
+    return True
+  def _saveSnapshot(self, snapshot):
+    u"""
+    Сохраняет только что разобранный проект в снимок snapshot вместе с состояниями и
+    хэшами всех его входных файлов. Если какой-либо из файлов изменился во время разбора
+    или снимок не удалось записать, снимок не сохраняется, на сам проект это не влияет.
+    Разобранное к этому моменту содержимое элементов сохраняется в снимке, остальное
+    после загрузки из снимка разбирается при первом обращении, как обычно.
+    """
+    inputs = [(path, stat, fileDigest(path)) for path, stat in self._inputs]
+    if any(self._fileStat(path) != stat for path, stat, digest in inputs):
+      print(u'[Snapshot] Project files changed while loading, snapshot %s is not saved' % snapshot)
+      return
+    state = dict((name, self.__dict__[name]) for name in self._snapshotAttributes)
+    temp = snapshot + '.tmp'
+    try:
+      makeDirs(os.path.dirname(os.path.abspath(snapshot)))
+      with open(temp, 'wb') as f:
+        f.write('%s %d\n' % (__SNAPSHOT_HEADER__, __SNAPSHOT_VERSION__))
+        cPickle.dump(inputs, f, cPickle.HIGHEST_PROTOCOL)
+        withoutGC(cPickle.dump, state, f, cPickle.HIGHEST_PROTOCOL)
+      replaceFile(temp, snapshot)
+    except (IOError, OSError, cPickle.PicklingError) as e:
+      if os.path.exists(temp):
+        os.remove(temp)
+      print(u'[Snapshot] Cannot save %s: %r' % (snapshot, e))
+      return
+    print(u'[Snapshot] Saved %s' % snapshot)
+  @staticmethod
+  def _inputsUnchanged(inputs):
+    u"""Возвращает True, если состояния и хэши файлов из inputs (см. _saveSnapshot) не изменились."""
+    # Хэши, для которых файлы нужно прочитать, сравниваются, только если совпали все размеры
+    # и времена изменения.
+    if any(K3AProject._fileStat(path) != stat for path, stat, digest in inputs):
+      return False
+    return all(fileDigest(path) == digest for path, stat, digest in inputs)
 ################################################################################
-  def _saveK3AFile(self):
+  def _writeK3AFile(self):
+    u"""
+    Записывает файл .k3a во временный файл рядом с ним и возвращает путь к временному
+    файлу. Если файл .k3a на диске уже содержит то же самое, возвращает None.
+    """
     path = self.k3aFile
-    if not os.path.exists(os.path.dirname(path)):
-      os.makedirs(os.path.dirname(path))
 
     root = ET.Element('K3A')
     ET.SubElement(root, 'ProjectName').text = self.name
     ET.SubElement(root, 'Version').text = str(self._version)
 
     indent(root)
-    ET.ElementTree(root).write(path, 'UTF-8', True)# Включаем XML-декларацию, для UTF-8 по умолчанию ее нет
-    print(u'[Saved] %s' % path)
+    data = StringIO()
+    ET.ElementTree(root).write(data, 'UTF-8', True)# Включаем XML-декларацию, для UTF-8 по умолчанию ее нет
+    data = data.getvalue()
+    if hashlib.md5(data).hexdigest() == fileDigest(path):
+      return None
+
+    makeDirs(os.path.dirname(path))
+    temp = path + '.tmp'
+    try:
+      with open(temp, 'wb') as f:
+        f.write(data)
+    except:
+      if os.path.exists(temp):
+        os.remove(temp)
+      raise
+    return temp
 ################################################################################
   def _levelToPath(self, level):
     path = os.path.join(self.dir, 'Configuration')
@@ -1039,18 +2390,127 @@ class K3AProject(object):
       print(u"WARNING: File %s don't contain file version" % path)
       print(sys.exc_info())
     return tuple()
-  @staticmethod
-  def _clearFolder(folder):
-    for file in os.listdir(folder):
-      path = os.path.join(folder, file)
-      try:
-        if os.path.isfile(path):
+  def _deleteUnusedFiles(self, used):
+    u"""Удаляет из папки конфигурации все файлы, кроме файлов из used, и оставшиеся пустыми папки."""
+    folder = self._levelToPath(MLS.NETWORK)
+    used = set(os.path.normcase(os.path.abspath(path)) for path in used)
+    for dir, dirs, files in os.walk(folder, topdown=False):
+      for file in files:
+        path = os.path.join(dir, file)
+        if os.path.normcase(os.path.abspath(path)) in used:
+          continue
+        try:
           os.unlink(path)
-        else:
-          shutil.rmtree(path)
-        print(u'[Deleted] %s' % path)
-      except:
-        print(str(sys.exc_info()[1]))
+          print(u'[Deleted] %s' % path)
+        except:
+          print(str(sys.exc_info()[1]))
+      if dir != folder and not os.listdir(dir):
+        try:
+          os.rmdir(dir)
+          print(u'[Deleted] %s' % dir)
+        except:
+          print(str(sys.exc_info()[1]))
+
+
+# Описывает элемент VALUE, содержимое которого не удалось разобрать.
+class K3AInvalidValue(object):
+  def __init__(self, path, namespace, name, error, fileLine=None):
+    # Полный путь к конфигурационному файлу.
+    self.path = path
+    # Значение атрибута Name элемента NAMESPACE (None, если сам файл не является
+    # правильным XML).
+    self.namespace = namespace
+    # Значение атрибута Name элемента VALUE (None, если сам файл не является
+    # правильным XML).
+    self.name = name
+    # Исключение Parser.SyntaxError, возникшее при разборе содержимого, или
+    # ET.ParseError, возникшее при разборе файла.
+    self.error = error
+    # Номер строки файла, в которой находится ошибка (None, если его не удалось определить).
+    self.fileLine = fileLine
+  def __unicode__(self):
+    if self.namespace is None:
+      return u'%s(%s): %s' % (self.path, self.fileLine or '?', self.error.args[0])
+    return u'%s(%s): %s/%s: line %s, column %s: %s' % (
+      self.path,
+      self.fileLine or '?',
+      self.namespace,
+      self.name,
+      self.line,
+      self.column,
+      self.error.args[0]
+    )
+  def __str__(self):
+    return unicode(self).encode('utf-8')
+  __repr__ = __str__
+  # Строка и столбец ошибки внутри содержимого элемента VALUE.
+  @property
+  def line(self):
+    return getattr(self.error, 'line', None)
+  @property
+  def column(self):
+    return getattr(self.error, 'column', None)
+
+def validateProject(path):
+  u"""
+  Проверяет содержимое элементов VALUE во всех конфигурационных файлах проекта.
+  В отличие от загрузки проекта, не останавливается на первой ошибке, а находит
+  все ошибки за один проход. Возвращает список K3AInvalidValue; файлы, которые
+  не удалось разобрать как XML, тоже попадают в него (см. K3AInvalidValue.namespace).
+
+  path - путь к файлу .k3a или к папке, в которой он лежит.
+  """
+  if os.path.isdir(path):
+    path = glob.glob(os.path.join(path, '*.k3a'))[0]
+  name = None
+  for e in ET.parse(path).getiterator('ProjectName'):
+    name = e.text
+    break
+
+  configDir = os.path.join(os.path.dirname(os.path.abspath(path)), 'Configuration')
+  errors = []
+  for dir in (configDir, os.path.join(configDir, 'Defaults')):
+    paths = glob.glob(os.path.join(dir, 'K3A.%s.*.xml' % name))
+    paths.extend(glob.glob(os.path.join(dir, 'MLS.Stores.xml')))
+    for p in sorted(paths):
+      _validateConfigFile(p, errors)
+  return errors
+
+# Начальный тег элемента VALUE в тексте конфигурационного файла.
+_valueTag = re.compile(r'<VALUE\b[^>]*>')
+
+def _validateConfigFile(path, errors):
+  u"""Добавляет в список errors все элементы VALUE файла path, которые не удалось разобрать."""
+  with open(path, 'rb') as f:
+    raw = f.read()
+  try:
+    root = ET.fromstring(raw)
+  except ET.ParseError as e:
+    # Файл целиком не разбирается -- сообщаем об этом и проверяем остальные файлы.
+    errors.append(K3AInvalidValue(path, None, None, e, e.position[0]))
+    return
+  values = [(ns, v) for ns in root.findall('./NAMESPACES/NAMESPACE') for v in ns.findall('VALUE')]
+
+  # Строки, с которых начинается содержимое элементов VALUE, нужны только для
+  # ошибочных элементов, поэтому вычисляются при первой ошибке.
+  lines = None
+  for i, (ns, value) in enumerate(values):
+    if value.text is None:
+      continue
+    try:
+      __valueTagParser__.parse(value.text)
+    except ParserError as e:
+      if lines is None:
+        index = LineIndex(raw)
+        tags = _valueTag.finditer(raw)
+        lines = [index.position(m.end())[0] for m in tags]
+        # Теги, найденные в тексте, соответствуют элементам, только если их столько же.
+        if len(lines) != len(values):
+          lines = []
+      fileLine = None
+      if lines and getattr(e, 'line', None) is not None:
+        fileLine = lines[i] + e.line - 1
+      errors.append(K3AInvalidValue(path, ns.get('Name'), value.get('Name'), e, fileLine))
 
 
 class Upgrader(object):
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+u"""
+Проверяет поиск элементов по имени в k3a.Container: индекс имен должен давать тот
+же результат, что и перебор списка, после любых изменений списка и переименований
+его элементов.
+
+Запуск: python -m unittest test_container
+"""
+import unittest
+
+import k3a
+
+def element(name):
+  return k3a.K3AProperty(None, name, '{{{},"%s"}}' % name)
+
+class ContainerIndexTest(unittest.TestCase):
+  u"""Индекс имен Container не устаревает после изменений списка (user-014)."""
+
+  def setUp(self):
+    self.items = k3a.Container(element(name) for name in ('a', 'b', 'c', 'b'))
+
+  def check(self):
+    u"""Сравнивает поиск по индексу с перебором списка для всех имен и одного отсутствующего."""
+    for name in set(e.name for e in self.items):
+      expected = [e for e in self.items if e.name == name][0]
+      self.assertIs(self.items[name], expected, name)
+      self.assertIs(getattr(self.items, name), expected, name)
+    self.assertRaises(TypeError, lambda: self.items['missing'])
+    self.assertRaises(AttributeError, lambda: self.items.missing)
+
+  def testLookup(self):
+    self.check()
+    # Из нескольких элементов с одним именем находится первый.
+    self.assertIs(self.items['b'], self.items[1])
+    # Числовые индексы работают как у списка.
+    self.assertEqual([self.items[i].name for i in (0, 2, -1)], ['a', 'c', 'b'])
+
+  def testMutations(self):
+    items = self.items
+    mutations = [
+      lambda: items.append(element('d')),
+      lambda: items.append(element('a')),
+      lambda: items.insert(0, element('b')),
+      lambda: items.remove(items[0]),
+      lambda: items.pop(1),
+      lambda: items.extend([element('e'), element('a')]),
+      lambda: items.__setitem__(0, element('f')),
+      lambda: items.__setslice__(1, 2, [element('g')]),
+      lambda: items.__delitem__(0),
+      lambda: items.__delslice__(0, 1),
+      lambda: items.__iadd__([element('h')]),
+      lambda: items.reverse(),
+      lambda: items.sort(key=lambda e: e.name),
+      lambda: items.__imul__(2),
+    ]
+    for mutate in mutations:
+      self.check()
+      version = items._version
+      mutate()
+      self.assertGreater(items._version, version)
+      self.check()
+
+  def testRenames(self):
+    self.check()
+    self.items[0].name = 'z'
+    self.check()
+    # Переименование элемента, который не входит в список, тоже учитывается.
+    other = k3a.Container([self.items[1]])
+    other['b']
+    self.items[1].name = 'y'
+    self.check()
+    self.assertIs(other['y'], self.items[1])
+    # Элемент с тем же именем, стоящий дальше, становится первым.
+    self.assertIs(self.items['b'], self.items[3])
+
+class ContainerCounterTest(unittest.TestCase):
+  u"""
+  Счетчик изменений проекта учитывает изменения состава списка, но не перестановки
+  его элементов, от которых индексы запросов не зависят (user-017).
+  """
+
+  def testCounter(self):
+    items = k3a.Container(element(name) for name in ('b', 'a', 'c'))
+    items._counter = counter = k3a.ChangeCounter()
+    for mutate in (lambda: items.sort(key=lambda e: e.name), items.reverse):
+      mutate()
+      self.assertEqual(counter.count, 0)
+    for mutate in (
+      lambda: items.append(element('d')),
+      lambda: items.insert(0, element('e')),
+      lambda: items.remove(items[0]),
+      items.pop,
+      lambda: items.__setitem__(0, element('f')),
+      lambda: items.__delitem__(0),
+    ):
+      count = counter.count
+      mutate()
+      self.assertGreater(counter.count, count)
+
+if __name__ == '__main__':
+  unittest.main()
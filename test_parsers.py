@@ -0,0 +1,155 @@
+# -*- encoding: utf-8 -*-
+u"""
+Проверяет, что все разборщики содержимого элементов VALUE из k3a.VALUE_PARSERS,
+созданные через k3a.makeValueParser, дают одинаковый результат, в том числе
+одинаковые типы строк.
+
+Запуск: python -m unittest test_parsers
+"""
+import unittest
+
+import k3a
+from Parser import ParserError
+from Parser import ParserPool
+from Parser import ValueElementContentParser
+
+# Содержимое элементов VALUE: виды, которые распознают шаблоны ShapeParser, и виды,
+# которые разбираются только общей грамматикой.
+CONTENTS = [
+  u'{{{},"GetContractInfo"}}',
+  u'{{null,"Common\\\\ConfirmSurcharge.htm"}}',
+  u'{{{},""}}',
+  u'{{null,""}}',
+  u'{{{},12}}',
+  u'{{{},-7}}',
+  u'{{{},true}}',
+  u'{{null,false}}',
+  u'{{{},null}}',
+  u'{{{},{}}}',
+  u'{{{},{"a","b","c"}}}',
+  u'{{{},{"Click","Main",false,"","OnClick","if (a \\003C b \\0026\\0026 c \\003E d) { s = \\"x\\"; }\\000A"}}}',
+  u'{{{},{"Click","Main",true,"frame","OnClick",""}}}',
+  u'{{{},"Строка \\0009 с табуляцией"}}',
+  u'{{{},{{{},"x"},12,true,null,{"y",{}}}}}',
+  u'{{{},{{{{{{"deep"}}}}}}}}',
+  u'{{{},{ "a" }}}',
+]
+
+INVALID = [
+  u'{{{},"unterminated}}',
+  u'{{{},{"a",}}}',
+  u'{{{},x}}',
+  u'{{{},{ "a" , {"b"} , -1 }}}',
+  u'{{{},{"a",\r\n"b",\n x}}}',
+  u'',
+]
+
+# Глубина вложенности списков, на которой рекурсивный разбор не справляется.
+DEPTH = 20000
+DEEP = u'{{{},%s"x"%s}}' % (u'{' * DEPTH, u'}' * DEPTH)
+DEEP_INVALID = u'{{{},%s"x",%s}}' % (u'{' * DEPTH, u'}' * DEPTH)
+
+def variants(content):
+  u"""Возвращает варианты строки content: unicode и, если она в ASCII, str."""
+  try:
+    return [content, content.encode('ascii')]
+  except UnicodeEncodeError:
+    return [content]
+
+def strings(value):
+  u"""Возвращает все строки из вложенных списков value."""
+  if isinstance(value, list):
+    return [s for item in value for s in strings(item)]
+  if isinstance(value, basestring):
+    return [value]
+  return []
+
+class FastFlagParser(ValueElementContentParser):
+  u"""Вместо результатов разбора возвращает значение параметра fast разборщика."""
+  def parse_many(self, inputs, processes = None):
+    if processes is not None:
+      return super(FastFlagParser, self).parse_many(inputs, processes)
+    return [self.fast] * len(inputs)
+
+class ValueParsersTest(unittest.TestCase):
+
+  def parsers(self):
+    return [(name, k3a.makeValueParser(name)) for name in sorted(k3a.VALUE_PARSERS)]
+
+  def testSameResults(self):
+    for content in CONTENTS:
+      for input in variants(content):
+        results = [(name, parser.parse(input)) for name, parser in self.parsers()]
+        expectedName, expected = results[0]
+        for name, result in results[1:]:
+          # repr различает 'x' и u'x', которые при сравнении равны.
+          self.assertEqual(repr(result), repr(expected),
+            '%s and %s differ on %r' % (name, expectedName, input))
+
+  def testStringsAreUnicode(self):
+    for name, parser in self.parsers():
+      for content in CONTENTS:
+        for input in variants(content):
+          for s in strings(parser.parse(input)):
+            self.assertIs(type(s), unicode, '%s returned %r for %r' % (name, s, input))
+
+  def testCachedResultKeepsType(self):
+    # 'abc' и u'abc' равны, но не должны получать результат друг друга из кэша.
+    for name, parser in self.parsers():
+      for content in CONTENTS:
+        results = [parser.parse(input) for input in variants(content)]
+        self.assertEqual(len(set(map(repr, results))), 1, '%s on %r' % (name, content))
+
+  def testParseMany(self):
+    inputs = [input for content in CONTENTS for input in variants(content)]
+    for name, parser in self.parsers():
+      single = [repr(k3a.makeValueParser(name).parse(input)) for input in inputs]
+      self.assertEqual(map(repr, parser.parse_many(inputs)), single, name)
+
+  def testParseManyInPool(self):
+    inputs = [input for content in CONTENTS for input in variants(content)] * 3
+    for name, parser in self.parsers():
+      single = [repr(k3a.makeValueParser(name).parse(input)) for input in inputs]
+      self.assertEqual(map(repr, parser.parse_many(inputs, 2)), single, name)
+      # Один пул используется для нескольких вызовов.
+      with ParserPool(k3a.VALUE_PARSERS[name](), 2) as pool:
+        for i in xrange(2):
+          self.assertEqual(map(repr, parser.parse_many(inputs, pool)), single, name)
+        self.assertRaises(ParserError, parser.parse_many, inputs + INVALID[:1], pool)
+        self.assertEqual(map(repr, parser.parse_many(inputs, pool)), single, name)
+
+  def testPoolKeepsConfiguration(self):
+    for fast in (True, False):
+      self.assertEqual(FastFlagParser(fast).parse_many(['x'] * 8, 2), [fast] * 8)
+
+  def error(self, parser, input):
+    u"""Возвращает сообщение и позицию ошибки, с которой parser не смог разобрать input."""
+    try:
+      parser.parse(input)
+    except ParserError as e:
+      return e.args[0], e.offset, e.line, e.column
+    self.fail('%r parsed' % input)
+
+  def testSameErrors(self):
+    for content in INVALID + [DEEP_INVALID]:
+      for input in variants(content):
+        errors = [(name, self.error(parser, input)) for name, parser in self.parsers()]
+        expectedName, expected = errors[0]
+        for name, error in errors[1:]:
+          self.assertEqual(error, expected, '%s and %s differ on %r' % (name, expectedName, input[:50]))
+
+  def testErrorPosition(self):
+    for name, parser in self.parsers():
+      self.assertEqual(self.error(parser, INVALID[-2]),
+        (u'Expected \'"\', \'-\', \'false\', \'null\', \'true\', \'{\' or [0-9] but x found.', 18, 3, 2), name)
+      self.assertEqual(self.error(parser, DEEP_INVALID)[1], len(DEEP_INVALID) - DEPTH - 2, name)
+
+  def testDeepNesting(self):
+    for name, parser in self.parsers():
+      value = parser.parse(DEEP)[0][1]
+      for i in xrange(DEPTH):
+        value = value[0]
+      self.assertEqual(value, u'x', name)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+# -*- encoding: utf-8 -*-
+u"""
+Проверяет запросы к проекту (K3AProject.query) и загрузку проекта из снимка на
+небольшом синтетическом проекте (см. generate.py).
+
+Запуск: python -m unittest -b test_project
+"""
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import generate
+import k3a
+
+class ProjectTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    generate.generateProject(self.dir, objects=8, properties=4, events=2, documents=1)
+    # Файлы приводятся к тому виду, в котором их записывает k3a.
+    k3a.K3AProject(self.dir).save(True)
+    self.project = k3a.K3AProject(self.dir)
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+class QueryTest(ProjectTestCase):
+  u"""Запросы по индексам дают то же, что и перебор всех объектов (user-017)."""
+
+  # Функции, возвращающие значения объекта для каждого условия запроса.
+  keys = {
+    'types'  : lambda o: [o.type],
+    'names'  : lambda o: [o.name],
+    'classes': lambda o: [o.cls],
+    'props'  : lambda o: [e.name for e in o.properties],
+    'events' : lambda o: [e.name for e in o.events],
+    'docs'   : lambda o: [e.name for e in o.documents],
+  }
+
+  def expected(self, **conditions):
+    result = [o for o in self.project._objects.values()
+      if all(set(values) & set(self.keys[key](o)) for key, values in conditions.iteritems())]
+    return sorted(result, key=lambda o: o.fullName)
+  def values(self, key):
+    return sorted(set(v for o in self.project._objects.values() for v in self.keys[key](o)))
+  def check(self):
+    for key in self.keys:
+      for value in self.values(key):
+        self.assertEqual(self.project.query(**{key: [value]}), self.expected(**{key: [value]}), (key, value))
+    types, props = self.values('types'), self.values('props')
+    self.assertEqual(self.project.query(types=types[:2], props=props[-3:]), self.expected(types=types[:2], props=props[-3:]))
+    self.assertEqual(self.project.query(names=['NoSuchObject']), [])
+
+  def testQuery(self):
+    self.check()
+
+  def testOrder(self):
+    objects = self.project.objects()
+    self.assertEqual(objects, sorted(objects, key=lambda o: o.fullName))
+    self.assertEqual(objects, self.project.query())
+    types = self.values('types')
+    self.assertEqual(self.project.objects(*types), objects)
+
+  def testChanges(self):
+    objects = [o for o in self.project.objects() if o._object is not None]
+    self.check()
+    objects[0]._object.name = 'Renamed'
+    self.check()
+    # Переименование вместе с добавлением и удалением элементов.
+    info = objects[1]._object
+    info.properties[0].name = 'RenamedProperty'
+    info.properties.append(k3a.K3AProperty(info, 'AddedProperty', '{{{},"new"}}'))
+    info.events.remove(info.events[0])
+    self.check()
+    self.assertIn(objects[1], self.project.query(props=['RenamedProperty']))
+    self.assertIn(objects[1], self.project.query(props=['AddedProperty']))
+
+  def testOtherProjectChanges(self):
+    self.project.query()
+    indexes = self.project._indexes
+    other = k3a.K3AProject(self.dir)
+    o = [o for o in other.objects() if o._object is not None][0]
+    o._object.name = 'Renamed'
+    o._object.properties.append(k3a.K3AProperty(o._object, 'AddedProperty', '{{{},"new"}}'))
+    self.project.save(True)
+    self.project.query()
+    self.assertIs(self.project._indexes, indexes)
+
+class SnapshotTest(ProjectTestCase):
+  u"""Проект, загруженный из снимка, не отличается от разобранного (user-025)."""
+
+  def setUp(self):
+    super(SnapshotTest, self).setUp()
+    self.snapshot = os.path.join(self.dir, 'project.snapshot')
+
+  def contents(self, project):
+    u"""Возвращает объекты проекта с содержимым их элементов в виде строк."""
+    return [(o.fullName, [(type(e).__name__, e.name, e.asString()) for e in o]) for o in project.objects()]
+  def loadSnapshot(self):
+    u"""Загружает проект из снимка, не давая разобрать его заново."""
+    parse = k3a.K3AProject._parseConfiguration
+    def failing(project):
+      self.fail('project is parsed instead of loading the snapshot')
+    k3a.K3AProject._parseConfiguration = failing
+    try:
+      return k3a.K3AProject(self.dir, snapshot=self.snapshot)
+    finally:
+      k3a.K3AProject._parseConfiguration = parse
+
+  def testSameAsParsed(self):
+    k3a.K3AProject(self.dir, snapshot=self.snapshot)
+    loaded = self.loadSnapshot()
+    self.assertEqual(self.contents(loaded), self.contents(self.project))
+    props = sorted(set(e.name for o in self.project.objects() for e in o.properties))
+    self.assertEqual(
+      [o.fullName for o in loaded.query(props=props[:3])],
+      [o.fullName for o in self.project.query(props=props[:3])])
+    # Загруженный проект сохраняется так же, как и разобранный.
+    self.assertEqual(loaded.save(True), [])
+    for project in (loaded, self.project):
+      info = [o for o in project.objects() if o._object is not None][0]._object
+      info.properties[0].value = u'changed'
+      info.properties[1].name = 'Renamed'
+    self.assertEqual(len(loaded.save(patch=True)), 1)
+    # Полная запись тех же изменений разобранного проекта дает то, что уже на диске.
+    self.assertEqual(self.project.save(), [])
+
+  def testDerivedCachesNotStored(self):
+    o = [o for o in self.project.objects() if o._object is not None][0]
+    name = o._object.properties[0].name
+    self.assertIs(o._object.properties[name], o._object.properties[0])
+    o.properties
+    copy = cPickle.loads(cPickle.dumps(o, cPickle.HIGHEST_PROTOCOL))
+    self.assertEqual(copy._views, {})
+    self.assertNotIn('_index', copy._object.properties.__dict__)
+    self.assertEqual(copy._object.properties[name].name, name)
+    self.assertEqual(copy._object.properties._version, o._object.properties._version)
+
+  def testNotSnapshot(self):
+    with open(self.snapshot, 'wb') as f:
+      f.write('not a snapshot')
+    self.assertRaises(k3a.SnapshotError, k3a.K3AProject, self.dir, snapshot=self.snapshot)
+    with open(self.snapshot, 'rb') as f:
+      self.assertEqual(f.read(), 'not a snapshot')
+
+  def testOtherVersion(self):
+    with open(self.snapshot, 'wb') as f:
+      f.write('%s 1\n' % k3a.__SNAPSHOT_HEADER__)
+    project = k3a.K3AProject(self.dir, snapshot=self.snapshot)
+    self.assertEqual(self.contents(project), self.contents(self.project))
+    self.assertEqual(self.contents(self.loadSnapshot()), self.contents(self.project))
+
+if __name__ == '__main__':
+  unittest.main()
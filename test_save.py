@@ -0,0 +1,329 @@
+# -*- encoding: utf-8 -*-
+u"""
+Проверяет сохранение проектов (K3AProject.save) на небольшом синтетическом проекте
+(см. generate.py).
+
+Запуск: python -m unittest -b test_save
+"""
+import errno
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import generate
+import k3a
+
+class SaveTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    generate.generateProject(self.dir, objects=6, properties=4, events=2, documents=1)
+    # Файлы приводятся к тому виду, в котором их записывает k3a.
+    k3a.K3AProject(self.dir).save(True)
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def files(self, dir=None):
+    dir = dir or self.dir
+    return sorted(glob.glob(os.path.join(dir, '*')) + glob.glob(os.path.join(dir, '*', '*')) +
+      glob.glob(os.path.join(dir, '*', '*', '*')))
+  def contents(self, dir=None):
+    u"""Возвращает отображение пути к файлу относительно папки проекта на его содержимое."""
+    dir = dir or self.dir
+    result = {}
+    for path in self.files(dir):
+      if os.path.isfile(path):
+        with open(path, 'rb') as f:
+          result[os.path.relpath(path, dir)] = f.read()
+    return result
+  def setOldTimes(self):
+    u"""Сдвигает время изменения всех файлов проекта в прошлое и возвращает его."""
+    past = int(time.time()) - 1000
+    for path in self.files():
+      if os.path.isfile(path):
+        os.utime(path, (past, past))
+    return past
+  def modifiedFiles(self, past):
+    return [path for path in self.files() if os.path.isfile(path) and os.path.getmtime(path) != past]
+  def someProperty(self, project):
+    u"""Возвращает свойство какого-нибудь объекта проекта и путь к файлу, в котором оно хранится."""
+    o = sorted(project.objects(), key=lambda o: o.fullName)[0]
+    info = o._default or o._object
+    # K3AObjectInfo сравниваются по имени, поэтому файл ищется по идентичности.
+    path = [c.path for c in project.configFiles() if any(i is info for i in c.objects())][0]
+    return sorted(info.properties, key=lambda e: e.name)[0], path
+  def changeFiles(self, project, count):
+    u"""Изменяет по одному свойству в count разных файлах конфигурации и возвращает пути к ним."""
+    paths = []
+    for conf in project.configFiles():
+      infos = [info for info in conf.objects() if info.properties]
+      if infos:
+        infos[0].properties[0].value = u'changed'
+        paths.append(conf.path)
+        if len(paths) == count:
+          return paths
+    self.fail('not enough files')
+  def leftovers(self):
+    return [path for path in self.files() if path.endswith(('.tmp', '.bak'))]
+
+class SkipSameContentTest(SaveTestCase):
+  u"""Файлы, содержимое которых совпадает с файлами на диске, не перезаписываются (user-024)."""
+
+  def testForcedSaveOfUnchangedProject(self):
+    past = self.setOldTimes()
+    project = k3a.K3AProject(self.dir)
+    self.assertEqual(project.save(True), [])
+    self.assertEqual(project.save(True, patch=True), [])
+    self.assertEqual(self.modifiedFiles(past), [])
+
+  def testOnlyChangedFileIsWritten(self):
+    past = self.setOldTimes()
+    project = k3a.K3AProject(self.dir)
+    prop, path = self.someProperty(project)
+    prop.value = u'changed'
+    self.assertEqual(project.save(True), [path])
+    self.assertEqual(self.modifiedFiles(past), [path])
+
+  def testChangedObjectWithSameContent(self):
+    # Файлы изменились, но на диске по новому пути уже лежит то же самое.
+    copy = tempfile.mkdtemp()
+    try:
+      shutil.rmtree(copy)
+      shutil.copytree(self.dir, copy)
+      past = int(time.time()) - 1000
+      for path in self.files(copy):
+        if os.path.isfile(path):
+          os.utime(path, (past, past))
+      project = k3a.K3AProject(self.dir)
+      project.dir = copy
+      self.assertEqual(project.save(), [])
+      self.assertEqual([p for p in self.files(copy) if os.path.getmtime(p) != past and os.path.isfile(p)], [])
+      self.assertEqual([p for p in self.files(copy) if p.endswith('.tmp')], [])
+    finally:
+      shutil.rmtree(copy)
+
+  def testNoTemporaryFilesForUnchangedFiles(self):
+    opened = []
+    def tracking(path, mode='r', *args):
+      if 'w' in mode:
+        opened.append(path)
+      return open(path, mode, *args)
+    project = k3a.K3AProject(self.dir)
+    k3a.open = tracking
+    try:
+      project.save(True)
+    finally:
+      del k3a.open
+    self.assertEqual(opened, [])
+
+class ChangeTrackingTest(SaveTestCase):
+  u"""Сохранение без force записывает только измененные файлы конфигурации (user-020)."""
+
+  def changed(self, project):
+    return [c.path for c in project.configFiles() if c.hasChanges()]
+
+  def testReadIsNotChange(self):
+    past = self.setOldTimes()
+    project = k3a.K3AProject(self.dir)
+    for o in project.objects():
+      for info in (o._object, o._default):
+        for e in (info or ()):
+          e.asString()
+          e._parsedContent
+    self.assertEqual(self.changed(project), [])
+    self.assertEqual(project.save(), [])
+    self.assertEqual(self.modifiedFiles(past), [])
+
+  def testChangesInPlace(self):
+    project = k3a.K3AProject(self.dir)
+    prop, path = self.someProperty(project)
+    prop.value = [u'a', u'b']
+    self.assertEqual(project.save(), [path])
+    project = k3a.K3AProject(self.dir)
+    prop, path = self.someProperty(project)
+    self.assertEqual(self.changed(project), [])
+    # Список, полученный из элемента, изменяется по месту.
+    prop.value.append(u'c')
+    self.assertTrue(prop.hasChanges())
+    self.assertEqual(self.changed(project), [path])
+    self.assertEqual(project.save(), [path])
+    self.assertEqual(self.changed(project), [])
+    prop, path = self.someProperty(k3a.K3AProject(self.dir))
+    self.assertEqual(prop.value, [u'a', u'b', u'c'])
+
+  def testOnlyChangedFilesAreWritten(self):
+    past = self.setOldTimes()
+    project = k3a.K3AProject(self.dir)
+    paths = self.changeFiles(project, 2)
+    info = [o._object for o in project.objects() if o._object is not None and o._object.events][-1]
+    info.events[0].name = 'RenamedEvent'
+    paths += [c.path for c in project.configFiles() if any(i is info for i in c.objects())]
+    paths = sorted(set(paths))
+    self.assertEqual(sorted(self.changed(project)), paths)
+    self.assertEqual(sorted(project.save()), paths)
+    self.assertEqual(sorted(self.modifiedFiles(past)), paths)
+    self.assertEqual(self.changed(project), [])
+    self.assertEqual(project.save(), [])
+
+class FailedSaveTest(SaveTestCase):
+  u"""При ошибке записи или замены любого файла файлы проекта остаются прежними (user-022)."""
+
+  def testWriteFailure(self):
+    before = self.contents()
+    project = k3a.K3AProject(self.dir)
+    paths = self.changeFiles(project, 3)
+    writeTemp = k3a.K3AConfigFile._writeTemp
+    def failing(conf, *args):
+      if conf.path == paths[1]:
+        raise IOError('write failed')
+      return writeTemp(conf, *args)
+    for workers in (None, 2):
+      k3a.K3AConfigFile._writeTemp = failing
+      try:
+        self.assertRaises(IOError, project.save, workers=workers)
+      finally:
+        k3a.K3AConfigFile._writeTemp = writeTemp
+      self.assertEqual(self.leftovers(), [])
+      self.assertEqual(self.contents(), before)
+
+  def testReplaceFailure(self):
+    before = self.contents()
+    project = k3a.K3AProject(self.dir)
+    paths = self.changeFiles(project, 3)
+    replaceFile = k3a.replaceFile
+    def failing(src, dst):
+      if dst == paths[1] and src.endswith('.tmp'):
+        raise OSError(errno.EACCES, 'Permission denied')
+      replaceFile(src, dst)
+    k3a.replaceFile = failing
+    try:
+      with self.assertRaises(OSError) as raised:
+        project.save(deleteUnusedFiles=True)
+    finally:
+      k3a.replaceFile = replaceFile
+    self.assertEqual(raised.exception.filename, paths[1])
+    self.assertEqual(self.leftovers(), [])
+    self.assertEqual(self.contents(), before)
+    # Изменения не отмечены сохраненными и записываются следующим сохранением.
+    self.assertEqual(sorted(project.save()), sorted(paths))
+
+  def testDeleteUnusedFiles(self):
+    project = k3a.K3AProject(self.dir)
+    before = self.contents()
+    unused = [
+      os.path.join(self.dir, 'Configuration', 'K3A.Other.Common.NETWORK.xml'),
+      os.path.join(self.dir, 'Configuration', 'Old', 'K3A.Other.Common.DEFAULT.xml'),
+    ]
+    os.mkdir(os.path.dirname(unused[1]))
+    for path in unused:
+      with open(path, 'wb') as f:
+        f.write('<Configuration/>')
+    project.save(deleteUnusedFiles=True)
+    self.assertEqual(self.contents(), before)
+    self.assertFalse(os.path.exists(os.path.dirname(unused[1])))
+
+class PatchSaveTest(SaveTestCase):
+  u"""
+  Сохранение по месту дает те же элементы, что и полная запись, и сохраняет
+  переводы строк исходного файла (user-023).
+  """
+
+  def copyProject(self, newline):
+    u"""Копирует проект в новую папку, заменяя переводы строк в файлах конфигурации на newline."""
+    copy = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, copy)
+    shutil.rmtree(copy)
+    shutil.copytree(self.dir, copy)
+    for path in self.configPaths(copy):
+      with open(path, 'rb') as f:
+        text = f.read()
+      with open(path, 'wb') as f:
+        f.write(text.replace('\r\n', '\n').replace('\n', newline))
+    return copy
+  def configPaths(self, dir):
+    return sorted(glob.glob(os.path.join(dir, 'Configuration', '*.xml')) +
+      glob.glob(os.path.join(dir, 'Configuration', 'Defaults', '*.xml')))
+  def model(self, dir):
+    u"""Возвращает элементы NAMESPACE и VALUE всех файлов конфигурации без учета порядка."""
+    result = {}
+    for path in self.configPaths(dir):
+      namespaces = k3a.readConfigFile(path)
+      result[os.path.relpath(path, dir)] = sorted(
+        (name, sorted((v[0], v[1]) for v in values)) for name, values, span in namespaces)
+    return result
+
+  def mutate(self, project, round):
+    u"""Изменяет, переименовывает, удаляет и добавляет элементы нескольких объектов."""
+    for o in sorted(project.objects(), key=lambda o: o.fullName)[:4]:
+      info = o._object or o._default
+      props = sorted(info.properties, key=lambda e: e.name)
+      props[0].value = u'round %d <&> "q"\n' % round
+      if len(props) > 1:
+        props[1].name = props[1].name + 'R'
+      if len(props) > 2:
+        info.properties.remove(props[2])
+      info.properties.append(k3a.K3AProperty(info, 'New%d' % round, '{{{},"new"}}'))
+      if info.documents:
+        info.documents.remove(sorted(info.documents, key=lambda e: e.name)[0])
+
+  def testSameAsFullSave(self):
+    for newline in ('\n', '\r\n'):
+      patched, full = self.copyProject(newline), self.copyProject(newline)
+      projects = [k3a.K3AProject(patched), k3a.K3AProject(full)]
+      # Второе и третье сохранения изменяют уже записанные по месту элементы, в
+      # третий раз -- после повторной загрузки проекта.
+      for round in xrange(3):
+        if round == 2:
+          projects = [k3a.K3AProject(patched), k3a.K3AProject(full)]
+        for project in projects:
+          self.mutate(project, round)
+        self.assertNotEqual(projects[0].save(patch=True), [])
+        projects[1].save()
+        self.assertEqual(self.model(patched), self.model(full), (repr(newline), round))
+        for path in self.configPaths(patched):
+          with open(path, 'rb') as f:
+            text = f.read()
+          text = text.replace(newline, '')
+          self.assertNotIn('\r', text, (path, repr(newline), round))
+          self.assertNotIn('\n', text, (path, repr(newline), round))
+
+class DeepValueTest(SaveTestCase):
+  u"""Глубоко вложенное содержимое читается, изменяется и сохраняется (user-004)."""
+  # Больше предела рекурсии: на такой глубине deepcopy и == возбуждают RuntimeError.
+  DEPTH = 5000
+
+  def deepValue(self, leaf):
+    value = leaf
+    for i in xrange(self.DEPTH):
+      value = [value]
+    return value
+  def innermost(self, value):
+    u"""Возвращает самый вложенный список value и глубину его вложенности."""
+    depth = 1
+    while isinstance(value[0], list):
+      value = value[0]
+      depth += 1
+    return value, depth
+
+  def testReadAndSave(self):
+    project = k3a.K3AProject(self.dir)
+    prop, path = self.someProperty(project)
+    prop.value = self.deepValue(u'deep')
+    self.assertEqual(project.save(), [path])
+    for patch, leaf in ((False, u'full'), (True, u'patch')):
+      project = k3a.K3AProject(self.dir)
+      prop, path = self.someProperty(project)
+      value = prop.value
+      # Прочитанное, но не измененное содержимое не сохраняется.
+      self.assertEqual(project.save(True, patch=patch), [])
+      items, depth = self.innermost(value)
+      self.assertEqual(depth, self.DEPTH)
+      items[0] = leaf
+      self.assertEqual(project.save(patch=patch), [path])
+      prop, path = self.someProperty(k3a.K3AProject(self.dir))
+      self.assertEqual(self.innermost(prop.value), ([leaf], self.DEPTH))
+
+if __name__ == '__main__':
+  unittest.main()
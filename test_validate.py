@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+u"""
+Проверяет поиск ошибок в содержимом элементов VALUE (k3a.validateProject) на
+небольшом синтетическом проекте (см. generate.py).
+
+Запуск: python -m unittest test_validate
+"""
+import glob
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import generate
+import k3a
+
+# Первый непустой элемент VALUE в тексте файла: начальный тег, содержимое, конечный тег.
+FIRST_VALUE = re.compile(r'(<VALUE\b[^>]*>)([^<]+)(</VALUE>)')
+
+class ValidateProjectTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    generate.generateProject(self.dir, objects=6, properties=4, events=2, documents=1)
+    self.paths = sorted(glob.glob(os.path.join(self.dir, 'Configuration', 'K3A.*.NETWORK.xml')))
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def rewrite(self, path, change):
+    with open(path, 'rb') as f:
+      text = f.read()
+    with open(path, 'wb') as f:
+      f.write(change(text))
+
+  def testValidProject(self):
+    self.assertEqual(k3a.validateProject(self.dir), [])
+
+  def testContinuesAfterBrokenFile(self):
+    broken, invalid = self.paths[0], self.paths[-1]
+    # Обрезанный файл не является правильным XML.
+    self.rewrite(broken, lambda text: text[:len(text) // 2])
+    self.rewrite(invalid, lambda text: FIRST_VALUE.sub(r'\1{{{},x}}\3', text, 1))
+    errors = k3a.validateProject(self.dir)
+    self.assertEqual([e.path for e in errors], [broken, invalid])
+    self.assertEqual((errors[0].namespace, errors[0].name), (None, None))
+    self.assertIsNotNone(errors[0].fileLine)
+    self.assertEqual((errors[1].line, errors[1].column), (1, 6))
+
+  def testMessages(self):
+    self.rewrite(self.paths[0], lambda text: FIRST_VALUE.sub(u'\\1{{{},ы}}\\3'.encode('utf-8'), text, 1))
+    error, = k3a.validateProject(self.dir)
+    message = unicode(error)
+    self.assertIs(type(message), unicode)
+    self.assertIn(u'ы', message)
+    self.assertEqual(str(error), message.encode('utf-8'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,6 +3,8 @@ from __future__ import print_function
 
 import k3a
 import argparse
+import multiprocessing
+import sys
 
 def processCommandLine():
   # Инициализируем парсер:
@@ -35,6 +37,32 @@ def processCommandLine():
     action='store_true',# Необязательная опция
     help=u'make upgrade but do not save upgraded files'
   )
+  parser.add_argument(
+    '--validate',
+    action='store_true',# Необязательная опция
+    help=u'check all VALUE elements of the project, report every syntax error and exit'
+  )
+  parser.add_argument(
+    '--patch',
+    action='store_true',# Необязательная опция
+    help=u'save changed files in place: rewrite only changed VALUE elements and keep the rest of each file byte for byte'
+  )
+  parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    help=u'read configuration files in parallel in a pool of this many processes'
+  )
+  parser.add_argument(
+    '--snapshot',
+    help=u'load the parsed project from this snapshot file while project files do not change, otherwise parse the project and rewrite the snapshot'
+  )
+  parser.add_argument(
+    '--value-parser',
+    dest='valueParser',
+    choices=sorted(k3a.VALUE_PARSERS),
+    default='scanner',
+    help=u'parser of VALUE elements content (default: %(default)s)'
+  )
   parser.add_argument(
     '-t', '--show-types',
     dest='types',
@@ -108,29 +136,22 @@ def showInfo(project, args, f=print):
       print('~'*80);
       print(u'Objects with %s: %s' % (prop, ', '.join(filter)));
       print('~'*80);
-      candidates = [];
-      for x in filter:
-        for o in project.objects():
-          if x in (p.name for p in o[prop]):
-            candidates.add(x);
-      for o in unique(candidates):
+      for o in project.query(**{prop: filter}):
         f(o);
   if args.types:
     print('~'*80);
     print(u'Objects with types: %s' % ', '.join(args.types));
     print('~'*80);
     for x in args.types:
-      for o in project.objects():
-        if o.type == x:
-          f(o);
+      for o in project.query(types=[x]):
+        f(o);
   if args.names:
     print('~'*80);
     print(u'Objects with names: %s' % ', '.join(args.names));
     print('~'*80);
     for x in args.names:
-      for o in project.objects():
-        if o.name == x:
-          f(o);
+      for o in project.query(names=[x]):
+        f(o);
   helper(args.props, 'props');
   helper(args.events, 'events');
   helper(args.docs, 'docs');
@@ -149,12 +170,26 @@ def showInfo(project, args, f=print):
   
 
 if __name__ == "__main__":
+  # Без этого собранный PyInstaller'ом exe при запуске пула процессов (--workers)
+  # повторно выполняет программу в каждом дочернем процессе
+  multiprocessing.freeze_support()
   # @type project k3a.K3AProject
   upgraders = (
     'upgrade-0_2_x_x-0_3_x_x',
   )
   args = processCommandLine();
-  project = k3a.K3AProject(args.path);
+  k3a.setValueParser(args.valueParser)
+  if args.validate:
+    errors = k3a.validateProject(args.path)
+    for e in errors:
+      print(unicode(e))
+    print(u'Invalid values found: %d' % len(errors))
+    sys.exit(errors and 1 or 0)
+  try:
+    project = k3a.K3AProject(args.path, workers=args.workers, snapshot=args.snapshot);
+  except k3a.SnapshotError as e:
+    print(e.args[0])
+    sys.exit(2)
   showInfo(project, args, lambda o: o.dump());
 
   upgrade(project, upgraders);
@@ -168,4 +203,4 @@ if __name__ == "__main__":
     print();
     print(u'Not save upgraded project because `--check` option was specified');
   else:
-    project.save(True);
\ No newline at end of file
+    project.save(patch=args.patch);
\ No newline at end of file